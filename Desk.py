@@ -1,58 +1,199 @@
 import sys
+import math
+import time
 import os.path
+import itertools
+from collections import OrderedDict
 
-from PyQt5.QtCore import Qt, QPoint
-from PyQt5.QtGui import QIcon, QPainter, QImage, QFont, QColor, QPen, QBrush
+from PyQt5.QtCore import Qt, QEvent, QSize, QPoint, QRect, QRectF, QPointF, QTimer, QObject, QRunnable, QThreadPool, QSaveFile, QIODevice, pyqtSignal
+from PyQt5.QtGui import QPainter, QImage, QFont, QColor, QImageWriter
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QPushButton, QLabel, QAction, QMenu, QToolBar, QMenuBar, \
-    QUndoCommand, QUndoStack, QSpinBox, QComboBox, QCheckBox, QMessageBox, QFormLayout, QVBoxLayout, QHBoxLayout, qApp, \
-    QFileDialog
+    QSpinBox, QComboBox, QCheckBox, QMessageBox, QFormLayout, QVBoxLayout, QHBoxLayout, qApp, QFileDialog, \
+    QProgressDialog, QTabBar
+
+from brushes import BRUSHES
+from canvas import Canvas, SourceImage, UndoCommand, COLORS, BACKGROUNDS, rescaled
+from documents import Document, Documents, MEMORY_BUDGET, carry_tools
+from export import PRESETS, export, report
+from journal import Journal, RECOVERY, journal_directories
+from atlas import icon
+from profiler import Profiler
+from tiles import TILE_SIZE, tile_rect, tile_keys, solid_tile
+
+MAX_CANVAS_SIZE = 32767
+
+
+class MipPyramid:
+    # Downscaled canvas tiles for zoomed-out views, kept per level: a level n tile covers 2**n canvas tiles a
+    # side. Where no layer has painted it is filled straight from the background's base, elsewhere it is built
+    # from the four tiles below it; it is dropped when the canvas under it changes. Every level holds at
+    # least the tiles of the last view drawn from it, so building the levels below never evicts them.
+    def __init__(self, limit=2048):
+        self.levels, self.limit, self.limits = {}, limit, {}
+
+    def area(self, rect, level):
+        scale = 2 ** level
+        return QRect(QPoint(rect.left() // scale, rect.top() // scale), QPoint(rect.right() // scale, rect.bottom() // scale))
+
+    def invalidate(self, rect):
+        if rect.isNull():
+            self.levels.clear()
+            return
+        for level, tiles in self.levels.items():
+            area = self.area(rect, level)
+            for key in tile_keys(area, area):
+                tiles.pop(key, None)
+
+    def tile(self, image, level, key):
+        tiles = self.levels.setdefault(level, OrderedDict())
+        tile = tiles.get(key)
+        if tile is not None:
+            tiles.move_to_end(key)
+            return tile
+        scale = 2 ** level
+        region = QRect(key[0] * scale * TILE_SIZE, key[1] * scale * TILE_SIZE, scale * TILE_SIZE, scale * TILE_SIZE)
+        base = image.layers[0].base
+        if any(layer.keys_in(region) for layer in image.layers):
+            if level == 1:
+                part = image.copy(region)
+            else:
+                part = QImage(2 * TILE_SIZE, 2 * TILE_SIZE, QImage.Format_ARGB32)
+                painter = QPainter(part)
+                painter.setCompositionMode(QPainter.CompositionMode_Source)
+                for dy in (0, 1):
+                    for dx in (0, 1):
+                        child = self.tile(image, level - 1, (key[0] * 2 + dx, key[1] * 2 + dy))
+                        painter.drawImage(dx * TILE_SIZE, dy * TILE_SIZE, child)
+                painter.end()
+        elif isinstance(base, QColor):
+            part = solid_tile(base)
+        else:
+            part = QImage(region.size(), QImage.Format_ARGB32)
+            painter = QPainter(part)
+            painter.translate(-region.topLeft())
+            image.layers[0].render_base(painter, region)
+            painter.end()
+        if part.width() != TILE_SIZE:
+            part = part.scaled(TILE_SIZE, TILE_SIZE, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        tile = tiles[key] = part
+        while len(tiles) > self.limits.get(level, self.limit):
+            tiles.popitem(last=False)
+        return tile
+
+    def render(self, painter, image, level, rect):
+        area = self.area(rect, level)
+        keys = tile_keys(area, area)
+        self.limits[level] = max(self.limit, len(keys))
+        painter.save()
+        painter.scale(2 ** level, 2 ** level)
+        for key in keys:
+            painter.drawImage(tile_rect(key).topLeft(), self.tile(image, level, key))
+        painter.restore()
+
+
+class TaskSignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+
+class ImageTask(QRunnable):
+    def __init__(self, job, *args):
+        super().__init__()
+        self.job, self.args = job, args
+        self.signals = TaskSignals()
+        self.cancelled = False
+
+    def run(self):
+        # Any failure has to reach the GUI thread, or the progress dialog waits for it forever.
+        try:
+            result = self.job(self, *self.args)
+        except Exception as error:
+            self.signals.failed.emit(str(error) or type(error).__name__)
+        else:
+            if not self.cancelled:
+                self.signals.finished.emit(result)
 
 
-class UndoCommand(QUndoCommand):
-    def __init__(self, parent):
-        super().__init__()
-        self.parent = parent
-        self.mPrevImage = parent.image.copy()
-        self.mCurrImage = parent.image.copy()
+def load_image(task, path, bounds):
+    source = SourceImage(path)
+    return source, source.read(size=source.fitted(bounds))
+
+
+def rescale_layers(task, background, image, source, size):
+    return rescaled(background, image, source, size)
+
+
+def filter_image(task, layers, steps):
+    # Cancel stops the job between steps instead of only dropping its result.
+    import filters
+    return [filters.run(layer, steps, lambda: task.cancelled) for layer in layers]
 
-    def undo(self):
-        self.mCurrImage = self.parent.image.copy()
-        self.parent.image = self.mPrevImage
-        self.parent.update()
 
-    def redo(self):
-        self.parent.image = self.mCurrImage
-        self.parent.update()
+def save_image(task, image, path):
+    file = QSaveFile(path)
+    if not file.open(QIODevice.WriteOnly):
+        raise OSError("%s: %s" % (path, file.errorString()))
+    writer = QImageWriter(file, os.path.splitext(path)[1][1:].lower().encode() or b"png")
+    if not writer.write(image.to_image()):
+        file.cancelWriting()
+        raise OSError("%s: %s" % (path, writer.errorString()))
+    if task.cancelled:
+        file.cancelWriting()
+    elif not file.commit():
+        raise OSError("%s: %s" % (path, file.errorString()))
+    return path
+
+
+def export_image(task, image, path, names):
+    return export(image.to_image(), path, names)
 
 
 class Desk(QMainWindow):
     def __init__(self):
+        self.startup, self.startup_mark = [], time.perf_counter()
         super().__init__()
         self.window = QMainWindow()
         self.setWindowTitle("Graphic editor - Desk")
         self.setStyleSheet("background-color: #777777")
-        self.mUndoStack = QUndoStack(self)
-        self.mUndoStack.setUndoLimit(30)
-        self.mUndoStack.canUndoChanged.connect(self.can_undo_changed)
-        self.mUndoStack.canRedoChanged.connect(self.can_redo_changed)
-        self.image = QImage(QApplication.desktop().width() - 200,
-                            QApplication.desktop().height() - 160,
-                            QImage.Format_ARGB32)
-        self.now_background = QColor(255, 255, 255)
-        self.image.fill(self.now_background)
+        self.canvas = Canvas(self.canvas_size().width(), self.canvas_size().height(), self)
+        self.startup_phase("canvas")
+        self.mUndoStack = self.canvas.mUndoStack
+        self.document = Document(self.canvas)
+        self.documents = Documents(int(os.environ.get("DESK_MEMORY_MB", 0)) * 1024 * 1024 or MEMORY_BUDGET)
+        self.documents.add(self.document)
+        self.pool, self.tasks = QThreadPool(self), []
+        self.journal, self.journal_ids = None, None
+        self.zoom, self.origin, self.pan_start = 1.0, QPointF(160, 90), None
+        self.mipmaps = MipPyramid()
+        self.profiler, self.overlay = Profiler(), None
+        self.new_win, self.selected_background = None, ""
+        self.export_win = None
         self.configure()
+        self.startup_phase("configure")
         self.actions()
+        self.startup_phase("actions")
         self.icon_actions()
+        self.startup_phase("icons")
         self.menu_bar()
+        self.startup_phase("menus")
         self.tool_bar()
+        self.startup_phase("toolbars")
+        self.connect_canvas()
         self.can_undo_changed(self.mUndoStack.canUndo())
         self.can_redo_changed(self.mUndoStack.canRedo())
-        self.start_pos = QPoint()
-        self.checkered_or_lined, self.mode = "", ""
+        self.mode = ""
         self.opening_file_name, self.saving_file_name, self.now_file_name = "", "", ""
-        self.now_size, self.now_color, self.drawing, self.size = None, None, False, 3
-        self.color_theme, self.fill_color, self.instrument = "Dark", "transparent", "brush"
-        self.brush_color, self.eraser_color = QColor(0, 0, 0), QColor(255, 255, 255)
+        self.color_theme = "Dark"
+
+    def startup_phase(self, name):
+        # Milliseconds per startup phase up to the first frame; DESK_STARTUP_TIMES=1 prints them.
+        now = time.perf_counter()
+        self.startup.append((name, round((now - self.startup_mark) * 1000, 2)))
+        self.startup_mark = now
+        if name == "first frame":
+            self.startup_mark = None
+            if os.environ.get("DESK_STARTUP_TIMES"):
+                print("startup: " + ", ".join("%s %.1f ms" % phase for phase in self.startup), file=sys.stderr)
 
     def actions(self):
         self.new = QAction("New", self)
@@ -64,18 +205,42 @@ class Desk(QMainWindow):
         self.save = QAction("Save as", self)
         self.save.triggered.connect(self.saving)
         self.save.setShortcut("Ctrl+S")
+        self.export_action = QAction("Export...", self)
+        self.export_action.triggered.connect(self.show_export)
+        self.export_action.setShortcut("Ctrl+Shift+E")
+        self.close_tab = QAction("Close", self)
+        self.close_tab.triggered.connect(lambda: self.close_document(self.tabs.currentIndex()))
+        self.close_tab.setShortcut("Ctrl+W")
         self.settings = QAction("Settings", self)
         self.settings.triggered.connect(self.show_settings)
         self.settings.setShortcut("Ctrl+Alt+S")
         self.clear = QAction("Clear")
         self.clear.triggered.connect(self.clearing)
         self.clear.setShortcut("Del")
+        self.deselect = QAction("Deselect", self)
+        self.deselect.triggered.connect(self.deselecting)
+        self.deselect.setShortcut("Ctrl+Shift+A")
         self.actionUndo = QAction("Undo")
-        self.actionUndo.triggered.connect(self.mUndoStack.undo)
+        self.actionUndo.triggered.connect(lambda: self.mUndoStack.undo())
         self.actionUndo.setShortcut("Ctrl+Z")
         self.actionRedo = QAction("Redo")
-        self.actionRedo.triggered.connect(self.mUndoStack.redo)
+        self.actionRedo.triggered.connect(lambda: self.mUndoStack.redo())
         self.actionRedo.setShortcut("Ctrl+Y")
+        self.zoom_in_action = QAction("Zoom in", self)
+        self.zoom_in_action.triggered.connect(self.zoom_in)
+        self.zoom_in_action.setShortcut("Ctrl++")
+        self.zoom_out_action = QAction("Zoom out", self)
+        self.zoom_out_action.triggered.connect(self.zoom_out)
+        self.zoom_out_action.setShortcut("Ctrl+-")
+        self.actual_size_action = QAction("Actual size", self)
+        self.actual_size_action.triggered.connect(self.actual_size)
+        self.actual_size_action.setShortcut("Ctrl+0")
+        self.profile_action = QAction("Performance overlay", self)
+        self.profile_action.setCheckable(True)
+        self.profile_action.toggled.connect(self.profiling)
+        self.profile_action.setShortcut("F12")
+        self.trace_action = QAction("Save trace...", self)
+        self.trace_action.triggered.connect(self.save_trace)
         self.exit = QAction("Exit", self)
         self.exit.triggered.connect(self.exiting)
         self.exit.setShortcut("Esc")
@@ -90,6 +255,28 @@ class Desk(QMainWindow):
         self.rectangle.triggered.connect(self.draw_rectangle)
         self.circle = QAction("Circle", self)
         self.circle.triggered.connect(self.draw_circle)
+        self.bucket = QAction("Bucket", self)
+        self.bucket.triggered.connect(self.filling)
+        self.select_area = QAction("Select", self)
+        self.select_area.triggered.connect(self.selecting)
+        self.edit_shapes = QAction("Edit shapes", self)
+        self.edit_shapes.triggered.connect(self.editing_shapes)
+        self.delete_shape = QAction("Delete shape", self)
+        self.delete_shape.triggered.connect(lambda: self.canvas.delete_picked())
+        self.delete_shape.setShortcut("Backspace")
+        for action in [self.brush, self.eraser, self.line, self.rectangle, self.circle, self.bucket, self.select_area]:
+            action.triggered.connect(lambda: self.canvas.pick(None))
+
+        self.invert_action = QAction("Invert", self)
+        self.invert_action.triggered.connect(lambda: self.apply_filter("Inverting", [("invert", {})]))
+        self.greyscale_action = QAction("Greyscale", self)
+        self.greyscale_action.triggered.connect(lambda: self.apply_filter("Greyscale", [("greyscale", {})]))
+        self.blur_action = QAction("Blur", self)
+        self.blur_action.triggered.connect(lambda: self.apply_filter("Blurring", [("blur", {"radius": 3})]))
+        self.threshold_action = QAction("Threshold", self)
+        self.threshold_action.triggered.connect(lambda: self.apply_filter("Threshold", [("threshold", {"level": 128})]))
+        self.levels_action = QAction("Auto levels", self)
+        self.levels_action.triggered.connect(lambda: self.apply_filter("Levels", [("levels", {})]))
 
         self.pink = QAction("Pink", self)
         self.pink.triggered.connect(self.made_pink)
@@ -115,36 +302,40 @@ class Desk(QMainWindow):
         self.white.triggered.connect(self.made_white)
         self.black = QAction("Black", self)
         self.black.triggered.connect(self.made_black)
+        for action in [self.pink, self.red, self.orange, self.yellow, self.green, self.light_blue, self.blue,
+                       self.violet, self.brown, self.grey, self.white, self.black]:
+            action.triggered.connect(self.restyle)
 
     def icon_actions(self):
-        self.new.setIcon(QIcon(os.path.join("icons", "new.png")))
-        self.open.setIcon(QIcon(os.path.join("icons", "open.png")))
-        self.save.setIcon(QIcon(os.path.join("icons", "save.png")))
-        self.settings.setIcon(QIcon(os.path.join("icons", "settings.png")))
-        self.exit.setIcon(QIcon(os.path.join("icons", "exit.png")))
-
-        self.actionUndo.setIcon(QIcon(os.path.join("icons", "undo.png")))
-        self.actionRedo.setIcon(QIcon(os.path.join("icons", "redo.png")))
-        self.clear.setIcon(QIcon(os.path.join("icons", "clear.png")))
-
-        self.brush.setIcon(QIcon(os.path.join("icons", "brush.png")))
-        self.eraser.setIcon(QIcon(os.path.join("icons", "eraser.png")))
-        self.line.setIcon(QIcon(os.path.join("icons", "line.png")))
-        self.rectangle.setIcon(QIcon(os.path.join("icons", "rectangle.png")))
-        self.circle.setIcon(QIcon(os.path.join("icons", "circle.png")))
-
-        self.pink.setIcon(QIcon(os.path.join("icons", "pink.png")))
-        self.red.setIcon(QIcon(os.path.join("icons", "red.png")))
-        self.orange.setIcon(QIcon(os.path.join("icons", "orange.png")))
-        self.yellow.setIcon(QIcon(os.path.join("icons", "yellow.png")))
-        self.green.setIcon(QIcon(os.path.join("icons", "green.png")))
-        self.light_blue.setIcon(QIcon(os.path.join("icons", "light_blue.png")))
-        self.blue.setIcon(QIcon(os.path.join("icons", "blue.png")))
-        self.violet.setIcon(QIcon(os.path.join("icons", "violet.png")))
-        self.brown.setIcon(QIcon(os.path.join("icons", "brown.png")))
-        self.grey.setIcon(QIcon(os.path.join("icons", "grey.png")))
-        self.white.setIcon(QIcon(os.path.join("icons", "white.png")))
-        self.black.setIcon(QIcon(os.path.join("icons", "black.png")))
+        self.new.setIcon(icon("new"))
+        self.open.setIcon(icon("open"))
+        self.save.setIcon(icon("save"))
+        self.settings.setIcon(icon("settings"))
+        self.exit.setIcon(icon("exit"))
+
+        self.actionUndo.setIcon(icon("undo"))
+        self.actionRedo.setIcon(icon("redo"))
+        self.clear.setIcon(icon("clear"))
+
+        self.brush.setIcon(icon("brush"))
+        self.eraser.setIcon(icon("eraser"))
+        self.line.setIcon(icon("line"))
+        self.rectangle.setIcon(icon("rectangle"))
+        self.circle.setIcon(icon("circle"))
+        self.bucket.setIcon(icon("bucket"))
+
+        self.pink.setIcon(icon("pink"))
+        self.red.setIcon(icon("red"))
+        self.orange.setIcon(icon("orange"))
+        self.yellow.setIcon(icon("yellow"))
+        self.green.setIcon(icon("green"))
+        self.light_blue.setIcon(icon("light_blue"))
+        self.blue.setIcon(icon("blue"))
+        self.violet.setIcon(icon("violet"))
+        self.brown.setIcon(icon("brown"))
+        self.grey.setIcon(icon("grey"))
+        self.white.setIcon(icon("white"))
+        self.black.setIcon(icon("black"))
 
     def menu_bar(self):
         self.menu = QMenuBar()
@@ -155,6 +346,8 @@ class Desk(QMainWindow):
         file_menu.addAction(self.new)
         file_menu.addAction(self.open)
         file_menu.addAction(self.save)
+        file_menu.addAction(self.export_action)
+        file_menu.addAction(self.close_tab)
         file_menu.addAction(self.settings)
         file_menu.addSeparator()
         file_menu.addAction(self.exit)
@@ -163,8 +356,27 @@ class Desk(QMainWindow):
         edit_menu.addAction(self.actionUndo)
         edit_menu.addAction(self.actionRedo)
         edit_menu.addSeparator()
+        edit_menu.addAction(self.select_area)
+        edit_menu.addAction(self.deselect)
+        edit_menu.addAction(self.edit_shapes)
+        edit_menu.addAction(self.delete_shape)
         edit_menu.addAction(self.clear)
 
+        filters_menu = self.menu.addMenu("F&ilters")
+        filters_menu.addAction(self.invert_action)
+        filters_menu.addAction(self.greyscale_action)
+        filters_menu.addAction(self.blur_action)
+        filters_menu.addAction(self.threshold_action)
+        filters_menu.addAction(self.levels_action)
+
+        view_menu = self.menu.addMenu("&View")
+        view_menu.addAction(self.zoom_in_action)
+        view_menu.addAction(self.zoom_out_action)
+        view_menu.addAction(self.actual_size_action)
+        view_menu.addSeparator()
+        view_menu.addAction(self.profile_action)
+        view_menu.addAction(self.trace_action)
+
     def contextMenuEvent(self, event):
         separator_1 = QAction(self)
         separator_1.setSeparator(True)
@@ -194,7 +406,11 @@ class Desk(QMainWindow):
         self.instruments.addAction(self.line)
         self.instruments.addAction(self.rectangle)
         self.instruments.addAction(self.circle)
+        self.instruments.addAction(self.bucket)
         self.instruments.addWidget(self.spin)
+        self.instruments.addWidget(self.brush_style)
+        self.instruments.addWidget(self.opacity)
+        self.instruments.addWidget(self.tolerance)
 
         self.label = QLabel("Filling shapes:")
         self.label.setStyleSheet("color: white")
@@ -226,19 +442,95 @@ class Desk(QMainWindow):
         self.file.addAction(self.actionRedo)
         self.file.addAction(self.new)
 
+        self.tabs = QTabBar()
+        self.tabs.setStyleSheet("color: white")
+        self.tabs.setTabsClosable(True)
+        self.tabs.setExpanding(False)
+        self.tabs.setFocusPolicy(Qt.NoFocus)
+        self.tabs.addTab(self.document.title())
+        self.tabs.currentChanged.connect(self.switch_document)
+        self.tabs.tabCloseRequested.connect(self.close_document)
+        self.pages = QToolBar("Documents", self)
+        self.pages.setStyleSheet("background-color: #555555")
+        self.pages.setMovable(False)
+        self.pages.addWidget(self.tabs)
+
         self.addToolBar(Qt.TopToolBarArea, self.instruments)
+        self.addToolBarBreak(Qt.TopToolBarArea)
+        self.addToolBar(Qt.TopToolBarArea, self.pages)
         self.addToolBar(Qt.LeftToolBarArea, self.colors)
         self.addToolBar(Qt.BottomToolBarArea, self.file)
 
+    def connect_canvas(self, connect=True):
+        # The window follows the canvas and undo stack of whichever document is active.
+        for signal, slot in [(self.canvas.changed, self.canvas_changed),
+                             (self.mUndoStack.canUndoChanged, self.can_undo_changed),
+                             (self.mUndoStack.canRedoChanged, self.can_redo_changed),
+                             (self.mUndoStack.cleanChanged, self.document_changed),
+                             (self.mUndoStack.indexChanged, self.document_changed)]:
+            if connect:
+                signal.connect(slot)
+            else:
+                signal.disconnect(slot)
+
+    def document_changed(self, *args):
+        self.tabs.setTabText(self.documents.index(self.document), self.document.title())
+        self.documents.enforce()
+
+    def new_document(self):
+        document = Document(Canvas(self.canvas_size().width(), self.canvas_size().height(), self))
+        self.documents.add(document)
+        self.tabs.setCurrentIndex(self.tabs.addTab(document.title()))
+        return document
+
+    def switch_document(self, index):
+        document = self.documents[index]
+        if document is self.document:
+            return
+        self.canvas.finish_stroke()
+        self.connect_canvas(False)
+        self.document.zoom, self.document.origin, self.document.path = self.zoom, self.origin, self.now_file_name
+        carry_tools(self.canvas, document.canvas)
+        self.document, self.canvas, self.mUndoStack = document, document.canvas, document.canvas.mUndoStack
+        self.zoom, self.origin, self.now_file_name = document.zoom, document.origin, document.path
+        self.documents.activate(document)
+        self.connect_canvas()
+        self.can_undo_changed(self.mUndoStack.canUndo())
+        self.can_redo_changed(self.mUndoStack.canRedo())
+        self.mipmaps.invalidate(QRect())
+        self.start_journal(document)
+        if self.profile_action.isChecked():
+            self.profiler.enable(self.hot_paths(), os.environ.get("DESK_TRACE"))
+        self.documents.enforce()
+        self.update()
+
+    def close_document(self, index):
+        # There is always one document open; closing the last one leaves an empty one.
+        document = self.documents[index]
+        if not document.canvas.mUndoStack.isClean():
+            msg = QMessageBox(QMessageBox.Question, "Desk", document.title()[:-2] + " has unsaved changes. Close it?",
+                              buttons=QMessageBox.Yes | QMessageBox.No, parent=self)
+            msg.setStyleSheet("color: #ffffff")
+            msg.exec()
+            if msg.standardButton(msg.clickedButton()) != QMessageBox.Yes:
+                return
+        if len(self.documents) == 1:
+            self.new_document()
+        if document is self.document:
+            self.tabs.setCurrentIndex(index + 1 if index + 1 < len(self.documents) else index - 1)
+        self.documents.remove(document)
+        self.tabs.removeTab(index)
+        if document.journal:
+            document.journal.close()
+        document.canvas.close()
+        document.canvas.deleteLater()
+
     def can_undo_changed(self, enabled):
         self.actionUndo.setEnabled(enabled)
 
     def can_redo_changed(self, enabled):
         self.actionRedo.setEnabled(enabled)
 
-    def make_undo_command(self):
-        self.mUndoStack.push(UndoCommand(self))
-
     def set_width(self, v):
         self.new_width = v
         self.button_3.setEnabled(True)
@@ -247,69 +539,50 @@ class Desk(QMainWindow):
         self.new_height = v
         self.button_3.setEnabled(True)
 
+    def canvas_size(self):
+        return QSize(QApplication.desktop().width() - 200, QApplication.desktop().height() - 160)
+
     def result(self):
-        self.make_undo_command()
-        if self.aspect:
-            self.image = self.image.scaled(self.new_width, self.new_height, Qt.KeepAspectRatio)
-        else:
-            self.image = self.image.scaled(self.new_width, self.new_height)
+        # The background goes first: refine_rescale() only swaps in the smooth layers while the rescale is
+        # still the latest command.
+        if self.selected_background and (QColor(self.selected_background), self.mode) != \
+                (self.canvas.now_background, self.canvas.checkered_or_lined):
+            self.canvas.set_background(self.selected_background, self.mode)
+        size = self.canvas.image.size().scaled(self.new_width, self.new_height,
+                                               Qt.KeepAspectRatio if self.aspect else Qt.IgnoreAspectRatio)
+        if size != self.canvas.image.size():
+            canvas = self.canvas
+            layers = canvas.rescale(self.new_width, self.new_height, self.aspect, smooth=False)
+            command = canvas.undo_command
+            self.run_background(lambda result: canvas.refine_rescale(command, *result), rescale_layers, *layers)
         if self.color_theme == "Dark":
             self.setStyleSheet("background-color: #777777")
             self.instruments.setStyleSheet("background-color: #555555")
             self.colors.setStyleSheet("background-color: #555555")
             self.file.setStyleSheet("background-color: #555555")
+            self.pages.setStyleSheet("background-color: #555555")
         elif self.color_theme == "Violet":
             self.setStyleSheet("background-color: #7851A9")
             self.instruments.setStyleSheet("background-color: #46394B")
             self.colors.setStyleSheet("background-color: #46394B")
             self.file.setStyleSheet("background-color: #46394B")
+            self.pages.setStyleSheet("background-color: #46394B")
         elif self.color_theme == "Blue":
             self.setStyleSheet("background-color: #606E8C")
             self.instruments.setStyleSheet("background-color: #2c3337")
             self.colors.setStyleSheet("background-color: #2c3337")
             self.file.setStyleSheet("background-color: #2c3337")
+            self.pages.setStyleSheet("background-color: #2c3337")
         elif self.color_theme == "Green":
             self.setStyleSheet("background-color: #355E3B")
             self.instruments.setStyleSheet("background-color: #2F4538")
             self.colors.setStyleSheet("background-color: #2F4538")
             self.file.setStyleSheet("background-color: #2F4538")
-        if self.selected_background == QColor(255, 255, 255):
-            if self.mode == "checkered":
-                self.light_checkered()
-            elif self.mode == "lined":
-                self.light_lined()
-            else:
-                self.made_white_background()
-        elif self.selected_background == QColor(100, 150, 100):
-            if self.mode == "checkered":
-                self.dark_checkered()
-            elif self.mode == "lined":
-                self.dark_lined()
-        elif self.selected_background == QColor(255, 100, 150):
-            self.made_pink_background()
-        elif self.selected_background == QColor(255, 0, 0):
-            self.made_red_background()
-        elif self.selected_background == QColor(255, 150, 0):
-            self.made_orange_background()
-        elif self.selected_background == QColor(255, 255, 0):
-            self.made_yellow_background()
-        elif self.selected_background == QColor(0, 255, 0):
-            self.made_green_background()
-        elif self.selected_background == QColor(0, 255, 255):
-            self.made_light_blue_background()
-        elif self.selected_background == QColor(0, 0, 255):
-            self.made_blue_background()
-        elif self.selected_background == QColor(150, 0, 255):
-            self.made_violet_background()
-        elif self.selected_background == QColor(150, 75, 0):
-            self.made_brown_background()
-        elif self.selected_background == QColor(100, 100, 100):
-            self.made_grey_background()
-        elif self.selected_background == QColor(0, 0, 0):
-            self.made_black_background()
-        self.spin_1.setValue(self.image.width())
-        self.spin_2.setValue(self.image.height())
-        self.button_3.setEnabled(False)
+            self.pages.setStyleSheet("background-color: #2F4538")
+        if self.new_win is not None:
+            self.spin_1.setValue(self.canvas.image.width())
+            self.spin_2.setValue(self.canvas.image.height())
+            self.button_3.setEnabled(False)
         self.update()
 
     def check_changed(self, f):
@@ -319,87 +592,32 @@ class Desk(QMainWindow):
             self.aspect = False
 
     def value_changed(self, x):
-        self.size = x
+        self.canvas.size = x
+        self.restyle()
+
+    def tolerance_changed(self, t):
+        self.canvas.tolerance = t
+
+    def brush_changed(self, name):
+        self.canvas.brush = BRUSHES[name]
+
+    def opacity_changed(self, value):
+        self.canvas.opacity = value / 100
 
     def text_changed(self, y):
-        if y == "Empty":
-            self.fill_color = "transparent"
-        elif y == "Pink":
-            self.fill_color = QColor(255, 100, 150)
-        elif y == "Red":
-            self.fill_color = QColor(255, 0, 0)
-        elif y == "Orange":
-            self.fill_color = QColor(255, 150, 0)
-        elif y == "Yellow":
-            self.fill_color = QColor(255, 255, 0)
-        elif y == "Green":
-            self.fill_color = QColor(0, 255, 0)
-        elif y == "Light blue":
-            self.fill_color = QColor(0, 255, 255)
-        elif y == "Blue":
-            self.fill_color = QColor(0, 0, 255)
-        elif y == "Violet":
-            self.fill_color = QColor(150, 0, 255)
-        elif y == "Brown":
-            self.fill_color = QColor(150, 75, 0)
-        elif y == "Grey":
-            self.fill_color = QColor(100, 100, 100)
-        elif y == "White":
-            self.fill_color = QColor(255, 255, 255)
-        elif y == "Black":
-            self.fill_color = QColor(0, 0, 0)
+        self.canvas.fill_color = COLORS.get(y, "transparent")
+        self.restyle()
+
+    def restyle(self):
+        # With a shape picked the colour, size and fill controls edit it instead of the next one.
+        if self.canvas.instrument == "pick":
+            self.canvas.restyle_picked()
 
     def color_changed(self, c):
-        self.instrument = "brush"
+        self.canvas.instrument = "brush"
         self.button_3.setEnabled(True)
-        if c == "White":
-            self.selected_background = QColor(255, 255, 255)
-            self.mode = ""
-        elif c in ["Light checkered", "Light lined"]:
-            self.selected_background = QColor(255, 255, 255)
-            if c == "Light checkered":
-                self.mode = "checkered"
-            else:
-                self.mode = "lined"
-        elif c in ["Dark checkered", "Dark lined"]:
-            self.selected_background = QColor(100, 150, 100)
-            if c == "Dark checkered":
-                self.mode = "checkered"
-            else:
-                self.mode = "lined"
-        elif c == "Pink":
-            self.selected_background = QColor(255, 100, 150)
-            self.mode = ""
-        elif c == "Red":
-            self.selected_background = QColor(255, 0, 0)
-            self.mode = ""
-        elif c == "Orange":
-            self.selected_background = QColor(255, 150, 0)
-            self.mode = ""
-        elif c == "Yellow":
-            self.selected_background = QColor(255, 255, 0)
-            self.mode = ""
-        elif c == "Green":
-            self.selected_background = QColor(0, 255, 0)
-            self.mode = ""
-        elif c == "Light blue":
-            self.selected_background = QColor(0, 255, 255)
-            self.mode = ""
-        elif c == "Blue":
-            self.selected_background = QColor(0, 0, 255)
-            self.mode = ""
-        elif c == "Violet":
-            self.selected_background = QColor(150, 0, 255)
-            self.mode = ""
-        elif c == "Brown":
-            self.selected_background = QColor(150, 75, 0)
-            self.mode = ""
-        elif c == "Grey":
-            self.selected_background = QColor(100, 100, 100)
-            self.mode = ""
-        elif c == "Black":
-            self.selected_background = QColor(0, 0, 0)
-            self.mode = ""
+        if c in BACKGROUNDS:
+            self.selected_background, self.mode = BACKGROUNDS[c]
 
     def theme_changed(self, t):
         if t == "Dark":
@@ -412,74 +630,163 @@ class Desk(QMainWindow):
             self.color_theme = "Green"
         self.button_3.setEnabled(True)
 
+    def to_image(self, pos):
+        return (math.floor((pos.x() - self.origin.x()) / self.zoom),
+                math.floor((pos.y() - self.origin.y()) / self.zoom))
+
+    def to_screen(self, rect):
+        return QRectF(rect.x() * self.zoom + self.origin.x(), rect.y() * self.zoom + self.origin.y(),
+                      rect.width() * self.zoom, rect.height() * self.zoom)
+
+    def set_zoom(self, zoom, center=None):
+        zoom = min(max(zoom, 1 / 16), 16)
+        if center is None:
+            center = QPointF(self.width() / 2, self.height() / 2)
+        self.origin = center - (center - self.origin) * (zoom / self.zoom)
+        self.zoom = zoom
+        self.update()
+
+    def zoom_in(self):
+        self.set_zoom(self.zoom * 1.25)
+
+    def zoom_out(self):
+        self.set_zoom(self.zoom / 1.25)
+
+    def actual_size(self):
+        self.zoom, self.origin = 1.0, QPointF(160, 90)
+        self.update()
+
+    def canvas_changed(self, rect):
+        self.mipmaps.invalidate(rect)
+        if rect.isNull():
+            self.update()
+        else:
+            self.update(self.to_screen(rect).toAlignedRect().adjusted(-1, -1, 1, 1))
+
     def paintEvent(self, event):
+        self.canvas.flush_stroke()
         painter = QPainter(self)
-        painter.drawImage(160, 90, self.image)
+        image = self.canvas.composite
+        exposed = QRectF(event.rect()).translated(-self.origin)
+        exposed = QRectF(exposed.x() / self.zoom, exposed.y() / self.zoom,
+                         exposed.width() / self.zoom, exposed.height() / self.zoom)
+        exposed = exposed.toAlignedRect().intersected(image.rect())
         painter.setBackground(QColor(255, 255, 255))
+        painter.translate(self.origin)
+        painter.scale(self.zoom, self.zoom)
+        if not exposed.isEmpty():
+            painter.setClipRect(image.rect())
+            painter.setRenderHint(QPainter.SmoothPixmapTransform, self.zoom < 1)
+            level = max(0, int(math.floor(math.log2(1 / self.zoom)))) if self.zoom < 1 else 0
+            if level:
+                self.mipmaps.render(painter, image, level, exposed)
+            else:
+                image.render(painter, exposed)
+        self.canvas.draw_preview(painter)
+        if self.startup_mark is not None:
+            painter.end()
+            self.startup_phase("first frame")
+
+    def hot_paths(self):
+        module = sys.modules[__name__]
+        paths = [(self, "mousePressEvent", "input.press", {"input": True}),
+                 (self, "mouseMoveEvent", "input.move", {"input": True}),
+                 (self, "mouseReleaseEvent", "input.release", {"input": True, "stroke": True}),
+                 (self, "tabletEvent", "input.tablet", {"input": True}),
+                 (self, "paintEvent", "paint", {"frame": True}),
+                 (self.canvas, "flush_stroke", "draw.flush", {}),
+                 (self.canvas.renderer, "paint", "draw.render", {}),
+                 (self.canvas, "replace_shape", "draw.shape", {}),
+                 (UndoCommand, "__init__", "undo.snapshot", {}),
+                 (UndoCommand, "undo", "undo.undo", {}),
+                 (UndoCommand, "redo", "undo.redo", {}),
+                 (module, "load_image", "io.open", {}),
+                 (module, "save_image", "io.save", {})]
+        if self.journal:
+            paths += [(self.journal, "write", "io.journal", {}),
+                      (self.journal, "write_checkpoint", "io.checkpoint", {})]
+        return paths
+
+    def profiling(self, on):
+        # DESK_TRACE=path also appends every stroke's spans to a Chrome trace file.
+        if on:
+            self.profiler.enable(self.hot_paths(), os.environ.get("DESK_TRACE"))
+            if self.overlay is None:
+                self.overlay = QLabel(self)
+                self.overlay.setStyleSheet("color: white; background-color: #333333")
+                self.overlay.setFont(QFont("Courier", 10))
+                self.overlay.setAttribute(Qt.WA_OpaquePaintEvent)
+                self.overlay_timer = QTimer(self)
+                self.overlay_timer.timeout.connect(self.refresh_overlay)
+                self.overlay_timer.setInterval(250)
+            self.refresh_overlay()
+            self.overlay.show()
+            self.overlay_timer.start()
+        else:
+            self.profiler.disable()
+            if self.overlay is not None:
+                self.overlay.hide()
+                self.overlay_timer.stop()
+
+    def refresh_overlay(self):
+        latest = self.profiler.latest
+        undo = sum(self.mUndoStack.command(i).byte_count() for i in range(self.mUndoStack.count()))
+        self.overlay.setText(" frame   %6.1f ms \n latency %6.1f ms \n undo    %6.1f MB " %
+                             (latest.get("paint", 0), latest.get("latency", 0), undo / 2 ** 20))
+        self.overlay.adjustSize()
+        self.overlay.move(10, self.height() - self.overlay.height() - 10)
+
+    def save_trace(self):
+        path = QFileDialog.getSaveFileName(self, "Saving trace", "desk-trace.json", "Chrome trace (*.json)")[0]
+        if path:
+            try:
+                self.profiler.dump(path)
+            except OSError as error:
+                QMessageBox.warning(self, "Desk", str(error))
 
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
-            self.make_undo_command()
-            self.start_pos = (event.x() - 160, event.y() - 90)
-            self.drawing = True
-            if self.instrument == "eraser":
-                self.now_color = self.eraser_color
-                self.now_size = self.size * 2
-            else:
-                self.now_color = self.brush_color
-                self.now_size = self.size
-
-            if self.instrument in ["brush", "eraser"]:
-                painter = QPainter(self.image)
-                painter.setPen(QPen(self.now_color, self.now_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-                painter.drawPoint(event.x() - 160, event.y() - 90)
-            elif self.instrument in ["line", "rectangle", "circle"]:
-                self.image.save(os.path.join("time", "time.png"))
-            self.update()
+            self.canvas.press(*self.to_image(event.pos()))
+        elif event.button() == Qt.MiddleButton:
+            self.pan_start = event.pos()
 
     def mouseMoveEvent(self, event):
-        if (event.buttons() & Qt.LeftButton) and self.drawing:
-            if self.instrument == "eraser":
-                self.now_color = self.eraser_color
-                self.now_size = self.size * 2
-                painter = QPainter(self.image)
-                painter.setPen(QPen(self.now_color, self.now_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-                painter.drawLine(self.start_pos[0], self.start_pos[1], event.x() - 160, event.y() - 90)
-                self.start_pos = (event.x() - 160, event.y() - 90)
-            else:
-                self.now_color = self.brush_color
-                self.now_size = self.size
-                if self.instrument == "brush":
-                    painter = QPainter(self.image)
-                    painter.setPen(QPen(self.now_color, self.now_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-                    painter.drawLine(self.start_pos[0], self.start_pos[1], event.x() - 160, event.y() - 90)
-                    self.start_pos = (event.x() - 160, event.y() - 90)
-                elif self.instrument == "line":
-                    self.image = QImage(os.path.join("time", "time.png"))
-                    painter = QPainter(self.image)
-                    painter.setPen(QPen(self.now_color, self.now_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-                    painter.drawLine(self.start_pos[0], self.start_pos[1], event.x() - 160, event.y() - 90)
-                elif self.instrument == "rectangle":
-                    self.image = QImage(os.path.join("time", "time.png"))
-                    painter = QPainter(self.image)
-                    painter.setPen(QPen(self.now_color, self.now_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-                    if self.fill_color != "transparent":
-                        painter.setBrush(QBrush(self.fill_color, Qt.SolidPattern))
-                    painter.drawRect(self.start_pos[0], self.start_pos[1],
-                                     event.x() - self.start_pos[0] - 160, event.y() - self.start_pos[1] - 90)
-                elif self.instrument == "circle":
-                    self.image = QImage(os.path.join("time", "time.png"))
-                    painter = QPainter(self.image)
-                    painter.setPen(QPen(self.now_color, self.now_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-                    if self.fill_color != "transparent":
-                        painter.setBrush(QBrush(self.fill_color, Qt.SolidPattern))
-                    painter.drawEllipse(self.start_pos[0], self.start_pos[1],
-                                        event.x() - self.start_pos[0] - 160, event.y() - self.start_pos[1] - 90)
+        if event.buttons() & Qt.LeftButton:
+            self.canvas.move(*self.to_image(event.pos()))
+        elif event.buttons() & Qt.MiddleButton and self.pan_start is not None:
+            self.origin += QPointF(event.pos() - self.pan_start)
+            self.pan_start = event.pos()
             self.update()
 
     def mouseReleaseEvent(self, event):
-        if event.button() == Qt.LeftButton and self.drawing:
-            self.drawing = False
+        if event.button() == Qt.LeftButton:
+            self.canvas.release()
+        elif event.button() == Qt.MiddleButton:
+            self.pan_start = None
+
+    def tabletEvent(self, event):
+        # A pen gives the brush its pressure; accepting the event stops Qt from also sending it as a mouse event.
+        if event.type() == QEvent.TabletPress and event.button() == Qt.LeftButton:
+            self.canvas.press(*self.to_image(event.pos()), event.pressure())
+        elif event.type() == QEvent.TabletMove and event.buttons() & Qt.LeftButton:
+            self.canvas.move(*self.to_image(event.pos()), event.pressure())
+        elif event.type() == QEvent.TabletRelease and event.button() == Qt.LeftButton:
+            self.canvas.release()
+        else:
+            event.ignore()
+            return
+        event.accept()
+
+    def wheelEvent(self, event):
+        delta = event.angleDelta()
+        if event.modifiers() & Qt.ControlModifier:
+            self.set_zoom(self.zoom * 1.25 ** (delta.y() / 120), QPointF(event.pos()))
+        elif event.modifiers() & Qt.ShiftModifier:
+            self.origin += QPointF(delta.y() / 2, delta.x() / 2)
+            self.update()
+        else:
+            self.origin += QPointF(delta.x() / 2, delta.y() / 2)
+            self.update()
 
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_N and event.modifiers() == Qt.ControlModifier:
@@ -494,54 +801,196 @@ class Desk(QMainWindow):
             self.mUndoStack.undo()
         elif event.key() == Qt.Key_Y and event.modifiers() == Qt.ControlModifier:
             self.mUndoStack.redo()
+        elif event.key() in (Qt.Key_Plus, Qt.Key_Equal) and event.modifiers() & Qt.ControlModifier:
+            self.zoom_in()
+        elif event.key() == Qt.Key_Minus and event.modifiers() & Qt.ControlModifier:
+            self.zoom_out()
+        elif event.key() == Qt.Key_0 and event.modifiers() & Qt.ControlModifier:
+            self.actual_size()
         elif event.key() == Qt.Key_Delete:
             self.clearing()
         elif event.key() == Qt.Key_Escape:
             self.exiting()
 
     def new_paper(self):
-        self.make_undo_command()
-        self.eraser.setEnabled(True)
-        self.background_color.setCurrentText("White")
-        self.image = QImage(QApplication.desktop().width() - 200, QApplication.desktop().height() - 160,
-                            QImage.Format_ARGB32)
-        self.now_background = QColor(255, 255, 255)
-        self.image.fill(self.now_background)
+        if self.new_win is not None:
+            self.background_color.setCurrentText("White")
+        self.new_document()
         self.selected_background, self.mode = "", ""
-        self.checkered_or_lined, self.eraser_color = "", QColor(255, 255, 255)
         self.opening_file_name, self.saving_file_name, self.now_file_name = "", "", ""
-        self.update()
+
+    def run_task(self, text, done, job, *args):
+        task = ImageTask(job, *args)
+        progress = QProgressDialog(text, "Cancel", 0, 0, self)
+        progress.setWindowTitle("Desk")
+        progress.setStyleSheet("color: white")
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(300)
+
+        def cancel():
+            task.cancelled = True
+            finish()
+
+        def finish():
+            progress.reset()
+            if task in self.tasks:
+                self.tasks.remove(task)
+
+        def finished(result):
+            finish()
+            if not task.cancelled:
+                done(result)
+
+        def failed(message):
+            finish()
+            if not task.cancelled:
+                QMessageBox.warning(self, "Desk", message)
+
+        progress.canceled.connect(cancel)
+        task.signals.finished.connect(finished)
+        task.signals.failed.connect(failed)
+        self.tasks.append(task)
+        self.pool.start(task)
+
+    def apply_filter(self, text, steps):
+        canvas = self.canvas
+        rect, area, layers, revision = canvas.filter_input(steps)
+        if not rect.isEmpty():
+            self.run_task(text + "...", lambda values: self.filtered(canvas, steps, rect, area, values, revision),
+                          filter_image, layers, steps)
+
+    def filtered(self, canvas, steps, rect, area, values, revision):
+        # Anything drawn while the filter ran is kept; the filter then has to be run again on top of it.
+        if not canvas.put_filtered(steps, rect, area, values, revision):
+            QMessageBox.warning(self, "Desk", "The picture changed while the filter ran, so it was not applied.")
+
+    def run_background(self, done, job, *args):
+        # Like run_task, without a dialog; on failure the caller keeps what it already shows.
+        task = ImageTask(job, *args)
+
+        def finished(result):
+            self.tasks.remove(task)
+            done(result)
+
+        task.signals.finished.connect(finished)
+        task.signals.failed.connect(lambda message: self.tasks.remove(task))
+        self.tasks.append(task)
+        self.pool.start(task)
 
     def opening(self):
         self.opening_file_name = QFileDialog.getOpenFileName(self, "Opening", "", "Image (*.jpeg;*.jpg;*.png)")[0]
         if self.opening_file_name:
-            self.make_undo_command()
-            self.now_file_name = self.opening_file_name
-            self.image = QImage(self.opening_file_name)
+            path = self.opening_file_name
+            self.run_task("Opening " + os.path.basename(path), lambda result: self.opened(path, *result),
+                          load_image, path, self.canvas_size())
+
+    def opened(self, path, source, image):
+        # A file opens in a tab of its own unless the current one is still empty.
+        if not self.document.pristine():
+            self.new_document()
+        self.now_file_name = self.document.path = path
+        self.canvas.load(source, image)
+        self.canvas.clear_history()
+        self.document_changed()
 
     def saving(self):
         self.saving_file_name = QFileDialog.getSaveFileName(self, "Saving", "", "Image (*.jpeg;*.jpg;*.png)")[0]
         if self.saving_file_name:
-            self.now_file_name = self.saving_file_name
-            self.image.save(self.saving_file_name)
+            document, index = self.document, self.mUndoStack.index()
+            self.canvas.sync()
+            self.run_task("Saving " + os.path.basename(self.saving_file_name),
+                          lambda path: self.saved(path, document, index),
+                          save_image, self.canvas.composite.snapshot(), self.saving_file_name)
+
+    def saved(self, path, document, index):
+        if document not in self.documents.documents:
+            return
+        document.path = path
+        if document is self.document:
+            self.now_file_name = path
+        if document.canvas.mUndoStack.index() == index:
+            document.canvas.mUndoStack.setClean()
+        self.tabs.setTabText(self.documents.index(document), document.title())
+
+    def export_window(self):
+        self.export_win = QWidget(self, Qt.Window)
+        self.export_win.setWindowModality(Qt.WindowModal)
+        self.export_win.setWindowTitle("Export")
+
+        main_label = QLabel("Presets", self.export_win)
+        self.export_checks = {name: QCheckBox(name, self.export_win) for name in PRESETS}
+        button_1 = QPushButton("Export", self.export_win)
+        button_2 = QPushButton("Cancel", self.export_win)
+
+        layout1 = QVBoxLayout()
+        for check in self.export_checks.values():
+            check.setFont(QFont("Arial", 10))
+            check.setStyleSheet("color: white")
+            check.stateChanged.connect(lambda: button_1.setEnabled(bool(self.export_presets())))
+            layout1.addWidget(check)
+        layout2 = QHBoxLayout()
+        layout2.addWidget(button_1)
+        layout2.addWidget(button_2)
+        main_layout = QVBoxLayout(self.export_win)
+        main_layout.addWidget(main_label)
+        main_layout.addLayout(layout1)
+        main_layout.addLayout(layout2)
+        self.export_win.setLayout(main_layout)
+
+        main_label.setAlignment(Qt.AlignCenter)
+        main_label.setFont(QFont("Arial", 20))
+        main_label.setStyleSheet("color: white")
+        button_1.setStyleSheet("color: white")
+        button_2.setStyleSheet("color: white")
+        self.export_checks["PNG, small"].setChecked(True)
+
+        button_1.clicked.connect(self.exporting)
+        button_2.clicked.connect(self.export_win.hide)
+
+    def show_export(self):
+        if self.export_win is None:
+            self.export_window()
+        self.export_win.show()
+
+    def export_presets(self):
+        return [name for name, check in self.export_checks.items() if check.isChecked()]
+
+    def exporting(self):
+        # Every checked preset is encoded at once, each in a process of its own; with more than one the preset
+        # name goes into the file name.
+        names = self.export_presets()
+        self.export_win.hide()
+        path = QFileDialog.getSaveFileName(self, "Exporting", "", "Image (*.jpeg;*.jpg;*.png)")[0]
+        if path:
+            self.canvas.sync()
+            self.run_task("Exporting " + os.path.basename(path), self.exported,
+                          export_image, self.canvas.composite.snapshot(), path, names)
+
+    def exported(self, results):
+        msg = QMessageBox(QMessageBox.Information, "Export", report(results), parent=self)
+        msg.setStyleSheet("color: #ffffff")
+        msg.exec()
 
     def configure(self):
         self.spin = QSpinBox()
+        self.brush_style = QComboBox()
+        self.opacity = QSpinBox()
+        self.tolerance = QSpinBox()
         self.combo = QComboBox()
 
-        self.combo.addItem(QIcon(os.path.join("icons", "transparent.png")), "Empty")
-        self.combo.addItem(QIcon(os.path.join("icons", "pink.png")), "Pink")
-        self.combo.addItem(QIcon(os.path.join("icons", "red.png")), "Red")
-        self.combo.addItem(QIcon(os.path.join("icons", "orange.png")), "Orange")
-        self.combo.addItem(QIcon(os.path.join("icons", "yellow.png")), "Yellow")
-        self.combo.addItem(QIcon(os.path.join("icons", "green.png")), "Green")
-        self.combo.addItem(QIcon(os.path.join("icons", "light_blue.png")), "Light blue")
-        self.combo.addItem(QIcon(os.path.join("icons", "blue.png")), "Blue")
-        self.combo.addItem(QIcon(os.path.join("icons", "violet.png")), "Violet")
-        self.combo.addItem(QIcon(os.path.join("icons", "brown.png")), "Brown")
-        self.combo.addItem(QIcon(os.path.join("icons", "grey.png")), "Grey")
-        self.combo.addItem(QIcon(os.path.join("icons", "white.png")), "White")
-        self.combo.addItem(QIcon(os.path.join("icons", "black.png")), "Black")
+        self.combo.addItem(icon("transparent"), "Empty")
+        self.combo.addItem(icon("pink"), "Pink")
+        self.combo.addItem(icon("red"), "Red")
+        self.combo.addItem(icon("orange"), "Orange")
+        self.combo.addItem(icon("yellow"), "Yellow")
+        self.combo.addItem(icon("green"), "Green")
+        self.combo.addItem(icon("light_blue"), "Light blue")
+        self.combo.addItem(icon("blue"), "Blue")
+        self.combo.addItem(icon("violet"), "Violet")
+        self.combo.addItem(icon("brown"), "Brown")
+        self.combo.addItem(icon("grey"), "Grey")
+        self.combo.addItem(icon("white"), "White")
+        self.combo.addItem(icon("black"), "Black")
 
         self.spin.setRange(3, 17)
         self.spin.setSingleStep(2)
@@ -549,10 +998,29 @@ class Desk(QMainWindow):
         self.spin.lineEdit().setReadOnly(True)
         self.spin.lineEdit().setStyleSheet("color: white")
         self.spin.valueChanged.connect(self.value_changed)
+        self.brush_style.addItems(list(BRUSHES))
+        self.brush_style.setFocusPolicy(Qt.NoFocus)
+        self.brush_style.setStyleSheet("color: white")
+        self.brush_style.currentTextChanged.connect(self.brush_changed)
+        self.opacity.setRange(5, 100)
+        self.opacity.setSingleStep(5)
+        self.opacity.setValue(100)
+        self.opacity.setPrefix("Opacity: ")
+        self.opacity.setSuffix("%")
+        self.opacity.setFocusPolicy(Qt.NoFocus)
+        self.opacity.setStyleSheet("color: white")
+        self.opacity.valueChanged.connect(self.opacity_changed)
+        self.tolerance.setRange(0, 255)
+        self.tolerance.setValue(self.canvas.tolerance)
+        self.tolerance.setPrefix("Tolerance: ")
+        self.tolerance.setFocusPolicy(Qt.NoFocus)
+        self.tolerance.setStyleSheet("color: white")
+        self.tolerance.valueChanged.connect(self.tolerance_changed)
         self.combo.setFocusPolicy(Qt.NoFocus)
         self.combo.setStyleSheet("color: white")
         self.combo.currentTextChanged.connect(self.text_changed)
 
+    def settings_window(self):
         self.new_win = QWidget(self, Qt.Window)
         self.new_win.setWindowModality(Qt.WindowModal)
         self.new_win.setWindowTitle("Settings")
@@ -572,30 +1040,29 @@ class Desk(QMainWindow):
         button_1 = QPushButton("OK", self.new_win)
         button_2 = QPushButton("Cancel", self.new_win)
         self.button_3 = QPushButton("Apply", self.new_win)
-        self.selected_background, self.mode = "", ""
 
-        self.spin_1.setRange(1, QApplication.desktop().width() - 200)
-        self.spin_2.setRange(1, QApplication.desktop().height() - 160)
-        self.background_color.addItem(QIcon(os.path.join("icons", "white.png")), "White")
-        self.background_color.addItem(QIcon(os.path.join("icons", "light_checkered.png")), "Light checkered")
-        self.background_color.addItem(QIcon(os.path.join("icons", "dark_checkered.png")), "Dark checkered")
-        self.background_color.addItem(QIcon(os.path.join("icons", "light_lined.png")), "Light lined")
-        self.background_color.addItem(QIcon(os.path.join("icons", "dark_lined.png")), "Dark lined")
-        self.background_color.addItem(QIcon(os.path.join("icons", "pink.png")), "Pink")
-        self.background_color.addItem(QIcon(os.path.join("icons", "red.png")), "Red")
-        self.background_color.addItem(QIcon(os.path.join("icons", "orange.png")), "Orange")
-        self.background_color.addItem(QIcon(os.path.join("icons", "yellow.png")), "Yellow")
-        self.background_color.addItem(QIcon(os.path.join("icons", "green.png")), "Green")
-        self.background_color.addItem(QIcon(os.path.join("icons", "light_blue.png")), "Light blue")
-        self.background_color.addItem(QIcon(os.path.join("icons", "blue.png")), "Blue")
-        self.background_color.addItem(QIcon(os.path.join("icons", "violet.png")), "Violet")
-        self.background_color.addItem(QIcon(os.path.join("icons", "brown.png")), "Brown")
-        self.background_color.addItem(QIcon(os.path.join("icons", "grey.png")), "Grey")
-        self.background_color.addItem(QIcon(os.path.join("icons", "black.png")), "Black")
-        self.theme.addItem(QIcon(os.path.join("icons", "black.png")), "Dark")
-        self.theme.addItem(QIcon(os.path.join("icons", "violet.png")), "Violet")
-        self.theme.addItem(QIcon(os.path.join("icons", "blue.png")), "Blue")
-        self.theme.addItem(QIcon(os.path.join("icons", "green.png")), "Green")
+        self.spin_1.setRange(1, MAX_CANVAS_SIZE)
+        self.spin_2.setRange(1, MAX_CANVAS_SIZE)
+        self.background_color.addItem(icon("white"), "White")
+        self.background_color.addItem(icon("light_checkered"), "Light checkered")
+        self.background_color.addItem(icon("dark_checkered"), "Dark checkered")
+        self.background_color.addItem(icon("light_lined"), "Light lined")
+        self.background_color.addItem(icon("dark_lined"), "Dark lined")
+        self.background_color.addItem(icon("pink"), "Pink")
+        self.background_color.addItem(icon("red"), "Red")
+        self.background_color.addItem(icon("orange"), "Orange")
+        self.background_color.addItem(icon("yellow"), "Yellow")
+        self.background_color.addItem(icon("green"), "Green")
+        self.background_color.addItem(icon("light_blue"), "Light blue")
+        self.background_color.addItem(icon("blue"), "Blue")
+        self.background_color.addItem(icon("violet"), "Violet")
+        self.background_color.addItem(icon("brown"), "Brown")
+        self.background_color.addItem(icon("grey"), "Grey")
+        self.background_color.addItem(icon("black"), "Black")
+        self.theme.addItem(icon("black"), "Dark")
+        self.theme.addItem(icon("violet"), "Violet")
+        self.theme.addItem(icon("blue"), "Blue")
+        self.theme.addItem(icon("green"), "Green")
 
         layout1 = QFormLayout()
         layout1.addRow(label_1, self.spin_1)
@@ -660,9 +1127,11 @@ class Desk(QMainWindow):
         self.button_3.clicked.connect(self.result)
 
     def show_settings(self):
+        if self.new_win is None:
+            self.settings_window()
         self.aspect = True
-        self.spin_1.setValue(self.image.width())
-        self.spin_2.setValue(self.image.height())
+        self.spin_1.setValue(self.canvas.image.width())
+        self.spin_2.setValue(self.canvas.image.height())
         self.check.setCheckState(Qt.Checked)
         self.button_3.setEnabled(False)
         self.new_win.show()
@@ -677,22 +1146,7 @@ class Desk(QMainWindow):
         self.new_win.hide()
 
     def clearing(self):
-        self.make_undo_command()
-        if self.now_file_name:
-            self.image = QImage(self.now_file_name)
-        else:
-            self.image.fill(self.now_background)
-            if self.now_background == QColor(100, 150, 100):
-                if self.checkered_or_lined == "checkered":
-                    self.made_checkered("dark")
-                elif self.checkered_or_lined == "lined":
-                    self.made_lined("dark")
-            elif self.now_background == QColor(255, 255, 255):
-                if self.checkered_or_lined == "checkered":
-                    self.made_checkered("light")
-                elif self.checkered_or_lined == "lined":
-                    self.made_lined("light")
-        self.update()
+        self.canvas.clear()
 
     def exiting(self):
         msg = QMessageBox(QMessageBox.Question, "Exit", "Are you sure you want to get out?",
@@ -703,197 +1157,120 @@ class Desk(QMainWindow):
         msg.exec()
         ans = msg.standardButton(msg.clickedButton())
         if ans == QMessageBox.Yes:
+            self.pool.waitForDone()
+            self.close_journals()
             exit()
 
+    def closeEvent(self, event):
+        self.pool.waitForDone()
+        self.close_journals()
+        super().closeEvent(event)
+
+    def recover_session(self):
+        # Every document journals into a directory of its own; each one left behind reopens in a tab.
+        directories = journal_directories()
+        journals = [journal for journal in map(Journal, directories) if journal.has_recovery()]
+        if journals:
+            msg = QMessageBox(QMessageBox.Question, "Recovery", "Desk was not closed properly. Restore the last session?",
+                              buttons=QMessageBox.Yes | QMessageBox.No, parent=self)
+            msg.setStyleSheet("color: #ffffff")
+            msg.exec()
+            if msg.standardButton(msg.clickedButton()) == QMessageBox.Yes:
+                for index, journal in enumerate(journals):
+                    document = self.new_document() if index else self.document
+                    journal.recover(document.canvas)
+                    document.journal = journal
+                    journal.start(document.canvas)
+        for name in directories:
+            if not any(document.journal and document.journal.directory == name for document in self.documents):
+                Journal(name).close()
+        self.journal_ids = itertools.count(int(os.path.basename(directories[-1])) + 1 if directories else 0)
+        self.start_journal(self.document)
+        self.checkpoint_timer = QTimer(self)
+        self.checkpoint_timer.timeout.connect(self.checkpoint)
+        self.checkpoint_timer.start(5 * 60 * 1000)
+
+    def start_journal(self, document):
+        # Until recover_session() has run nothing is journalled.
+        if document.journal is None and self.journal_ids is not None:
+            document.journal = Journal(os.path.join(RECOVERY, str(next(self.journal_ids))))
+            document.journal.start(document.canvas)
+        self.journal = document.journal
+
+    def checkpoint(self):
+        if self.journal.written:
+            self.journal.checkpoint(self.canvas)
+
+    def close_journals(self):
+        for document in self.documents:
+            if document.journal:
+                document.journal.close()
+                document.journal = None
+                document.canvas.journal = None
+        self.journal = None
+
     def brushing(self):
-        self.instrument = "brush"
+        self.canvas.instrument = "brush"
 
     def erasing(self):
-        self.instrument = "eraser"
+        self.canvas.instrument = "eraser"
 
     def draw_line(self):
-        self.instrument = "line"
+        self.canvas.instrument = "line"
 
     def draw_rectangle(self):
-        self.instrument = "rectangle"
+        self.canvas.instrument = "rectangle"
 
     def draw_circle(self):
-        self.instrument = "circle"
+        self.canvas.instrument = "circle"
+
+    def filling(self):
+        self.canvas.instrument = "bucket"
+
+    def selecting(self):
+        self.canvas.instrument = "select"
+
+    def deselecting(self):
+        self.canvas.select(None)
+
+    def editing_shapes(self):
+        self.canvas.instrument = "pick"
 
     def made_pink(self):
-        self.brush_color = QColor(255, 100, 150)
+        self.canvas.brush_color = QColor(255, 100, 150)
 
     def made_red(self):
-        self.brush_color = QColor(255, 0, 0)
+        self.canvas.brush_color = QColor(255, 0, 0)
 
     def made_orange(self):
-        self.brush_color = QColor(255, 150, 0)
+        self.canvas.brush_color = QColor(255, 150, 0)
 
     def made_yellow(self):
-        self.brush_color = QColor(255, 255, 0)
+        self.canvas.brush_color = QColor(255, 255, 0)
 
     def made_green(self):
-        self.brush_color = QColor(0, 255, 0)
+        self.canvas.brush_color = QColor(0, 255, 0)
 
     def made_light_blue(self):
-        self.brush_color = QColor(0, 255, 255)
+        self.canvas.brush_color = QColor(0, 255, 255)
 
     def made_blue(self):
-        self.brush_color = QColor(0, 0, 255)
+        self.canvas.brush_color = QColor(0, 0, 255)
 
     def made_violet(self):
-        self.brush_color = QColor(150, 0, 255)
+        self.canvas.brush_color = QColor(150, 0, 255)
 
     def made_brown(self):
-        self.brush_color = QColor(150, 75, 0)
+        self.canvas.brush_color = QColor(150, 75, 0)
 
     def made_grey(self):
-        self.brush_color = QColor(100, 100, 100)
+        self.canvas.brush_color = QColor(100, 100, 100)
 
     def made_white(self):
-        self.brush_color = QColor(255, 255, 255)
+        self.canvas.brush_color = QColor(255, 255, 255)
 
     def made_black(self):
-        self.brush_color = QColor(0, 0, 0)
-
-    def made_lined(self, color):
-        painter = QPainter(self.image)
-        self.checkered_or_lined = "lined"
-        if color == "light":
-            painter.setPen(QPen(QColor(0, 150, 150), 3, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-        else:
-            painter.setPen(QPen(QColor(255, 255, 255), 3, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-        for y in range(0, QApplication.desktop().height() - 160, 60):
-            painter.drawLine(0, y, QApplication.desktop().width() - 200, y)
-
-    def made_checkered(self, color):
-        painter = QPainter(self.image)
-        self.checkered_or_lined = "checkered"
-        if color == "light":
-            painter.setPen(QPen(QColor(0, 150, 150), 3, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-        else:
-            painter.setPen(QPen(QColor(255, 255, 255), 3, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-        for x in range(0, QApplication.desktop().width() - 200, 45):
-            painter.drawLine(x, 0, x, QApplication.desktop().height() - 160)
-        for y in range(0, QApplication.desktop().height() - 160, 45):
-            painter.drawLine(0, y, QApplication.desktop().width() - 200, y)
-
-    def light_lined(self):
-        self.make_undo_command()
-        self.now_background = QColor(255, 255, 255)
-        self.instrument = "brush"
-        self.eraser.setEnabled(False)
-        self.image.fill(self.now_background)
-        self.made_lined("light")
-
-    def dark_lined(self):
-        self.make_undo_command()
-        self.now_background = QColor(100, 150, 100)
-        self.instrument = "brush"
-        self.eraser.setEnabled(False)
-        self.image.fill(self.now_background)
-        self.made_lined("dark")
-
-    def light_checkered(self):
-        self.make_undo_command()
-        self.now_background = QColor(255, 255, 255)
-        self.instrument = "brush"
-        self.eraser.setEnabled(False)
-        self.image.fill(self.now_background)
-        self.made_checkered("light")
-
-    def dark_checkered(self):
-        self.make_undo_command()
-        self.now_background = QColor(100, 150, 100)
-        self.instrument = "brush"
-        self.eraser.setEnabled(False)
-        self.image.fill(self.now_background)
-        self.made_checkered("dark")
-
-    def made_pink_background(self):
-        self.make_undo_command()
-        self.now_background = QColor(255, 100, 150)
-        self.eraser_color = QColor(255, 100, 150)
-        self.eraser.setEnabled(True)
-        self.image.fill(self.now_background)
-
-    def made_red_background(self):
-        self.make_undo_command()
-        self.now_background = QColor(255, 0, 0)
-        self.eraser_color = QColor(255, 0, 0)
-        self.eraser.setEnabled(True)
-        self.image.fill(self.now_background)
-
-    def made_orange_background(self):
-        self.make_undo_command()
-        self.now_background = QColor(255, 150, 0)
-        self.eraser_color = QColor(255, 150, 0)
-        self.eraser.setEnabled(True)
-        self.image.fill(self.now_background)
-
-    def made_yellow_background(self):
-        self.make_undo_command()
-        self.now_background = QColor(255, 255, 0)
-        self.eraser_color = QColor(255, 255, 0)
-        self.eraser.setEnabled(True)
-        self.image.fill(self.now_background)
-
-    def made_green_background(self):
-        self.make_undo_command()
-        self.now_background = QColor(0, 255, 0)
-        self.eraser_color = QColor(0, 255, 0)
-        self.eraser.setEnabled(True)
-        self.image.fill(self.now_background)
-
-    def made_light_blue_background(self):
-        self.make_undo_command()
-        self.now_background = QColor(0, 255, 255)
-        self.eraser_color = QColor(0, 255, 255)
-        self.eraser.setEnabled(True)
-        self.image.fill(self.now_background)
-
-    def made_blue_background(self):
-        self.make_undo_command()
-        self.now_background = QColor(0, 0, 255)
-        self.eraser_color = QColor(0, 0, 255)
-        self.eraser.setEnabled(True)
-        self.image.fill(self.now_background)
-
-    def made_violet_background(self):
-        self.make_undo_command()
-        self.now_background = QColor(150, 0, 255)
-        self.eraser_color = QColor(150, 0, 255)
-        self.eraser.setEnabled(True)
-        self.image.fill(self.now_background)
-
-    def made_brown_background(self):
-        self.make_undo_command()
-        self.now_background = QColor(150, 75, 0)
-        self.eraser_color = QColor(150, 75, 0)
-        self.eraser.setEnabled(True)
-        self.image.fill(self.now_background)
-
-    def made_grey_background(self):
-        self.make_undo_command()
-        self.now_background = QColor(100, 100, 100)
-        self.eraser_color = QColor(100, 100, 100)
-        self.eraser.setEnabled(True)
-        self.image.fill(self.now_background)
-
-    def made_white_background(self):
-        self.make_undo_command()
-        self.checkered_or_lined = ""
-        self.now_background = QColor(255, 255, 255)
-        self.eraser_color = QColor(255, 255, 255)
-        self.eraser.setEnabled(True)
-        self.image.fill(self.now_background)
-
-    def made_black_background(self):
-        self.make_undo_command()
-        self.now_background = QColor(0, 0, 0)
-        self.eraser_color = QColor(0, 0, 0)
-        self.eraser.setEnabled(True)
-        self.image.fill(self.now_background)
+        self.canvas.brush_color = QColor(0, 0, 0)
 
 
 if __name__ == "__main__":
@@ -902,5 +1279,8 @@ if __name__ == "__main__":
     my_app.setFixedWidth(QApplication.desktop().width())
     my_app.setFixedHeight(QApplication.desktop().height())
     my_app.showFullScreen()
+    my_app.recover_session()
+    if os.environ.get("DESK_TRACE"):
+        my_app.profile_action.setChecked(True)
     my_app.show()
     sys.exit(app.exec_())
@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+
+from PyQt5.QtCore import Qt, QRect
+from PyQt5.QtGui import QIcon, QImage, QPainter, QPixmap
+
+ICON_SIZE = 64
+COLUMNS = 8
+DIRECTORY = "icons"
+
+
+class Atlas:
+    # All icons come from one pre-packed image (python atlas.py re-packs icons/*.png); each QIcon is cut
+    # out once and shared. An icon missing from the atlas is read from its own file.
+    def __init__(self, directory=DIRECTORY):
+        self.directory, self.pixmap, self.cells, self.icons = directory, None, None, {}
+
+    def load(self):
+        self.cells = {}
+        try:
+            with open(os.path.join(self.directory, "atlas.json")) as f:
+                self.cells = json.load(f)
+        except OSError:
+            return
+        self.pixmap = QPixmap(os.path.join(self.directory, "atlas.png"))
+
+    def icon(self, name):
+        if name not in self.icons:
+            if self.cells is None:
+                self.load()
+            if name in self.cells and self.pixmap is not None and not self.pixmap.isNull():
+                self.icons[name] = QIcon(self.pixmap.copy(QRect(*self.cells[name])))
+            else:
+                self.icons[name] = QIcon(os.path.join(self.directory, name + ".png"))
+        return self.icons[name]
+
+
+ATLAS = Atlas()
+
+
+def icon(name):
+    return ATLAS.icon(name)
+
+
+def pack(directory=DIRECTORY):
+    names = sorted(name[:-len(".png")] for name in os.listdir(directory)
+                   if name.endswith(".png") and name != "atlas.png")
+    atlas = QImage(COLUMNS * ICON_SIZE, -(-len(names) // COLUMNS) * ICON_SIZE, QImage.Format_ARGB32)
+    atlas.fill(Qt.transparent)
+    painter = QPainter(atlas)
+    cells = {}
+    for i, name in enumerate(names):
+        image = QImage(os.path.join(directory, name + ".png"))
+        if image.width() > ICON_SIZE or image.height() > ICON_SIZE:
+            image = image.scaled(ICON_SIZE, ICON_SIZE, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        x, y = i % COLUMNS * ICON_SIZE, i // COLUMNS * ICON_SIZE
+        painter.drawImage(x, y, image)
+        cells[name] = [x, y, image.width(), image.height()]
+    painter.end()
+    if not atlas.save(os.path.join(directory, "atlas.png")):
+        raise OSError("cannot write " + os.path.join(directory, "atlas.png"))
+    with open(os.path.join(directory, "atlas.json"), "w") as f:
+        json.dump(cells, f, sort_keys=True)
+    return cells
+
+
+if __name__ == "__main__":
+    print("%d icons packed" % len(pack(sys.argv[1] if len(sys.argv) > 1 else DIRECTORY)))
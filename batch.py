@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PyQt5.QtCore import QRect
+from PyQt5.QtGui import QColor
+
+from brushes import BRUSHES
+from canvas import Canvas, COLORS, BACKGROUNDS
+
+
+def parse_color(value, default=None):
+    if value is None:
+        return default
+    if value in ("Empty", "transparent"):
+        return "transparent"
+    if isinstance(value, str):
+        if value in COLORS:
+            return QColor(COLORS[value])
+        return QColor(value)
+    return QColor(*value)
+
+
+def set_background(canvas, value):
+    if value in BACKGROUNDS:
+        canvas.set_background(*BACKGROUNDS[value])
+    else:
+        canvas.set_background(parse_color(value))
+
+
+def run_operation(canvas, operation):
+    if "background" in operation:
+        set_background(canvas, operation["background"])
+        return
+    if "filter" in operation:
+        params = {key: value for key, value in operation.items() if key not in ("filter", "rect")}
+        rect = QRect(*operation["rect"]) if "rect" in operation else None
+        canvas.apply_filter([(operation["filter"], params)], rect)
+        return
+    points = operation["points"]
+    canvas.instrument = operation.get("tool", "brush")
+    canvas.brush_color = parse_color(operation.get("color"), QColor(0, 0, 0))
+    canvas.size = operation.get("size", 3)
+    canvas.fill_color = parse_color(operation.get("fill"), "transparent")
+    canvas.tolerance = operation.get("tolerance", 32)
+    canvas.brush = BRUSHES[operation.get("brush", "Hard round")]
+    canvas.opacity = operation.get("opacity", 1.0)
+    canvas.press(*points[0])
+    for point in points[1:]:
+        canvas.move(*point)
+    canvas.release()
+
+
+def render(script):
+    canvas = Canvas(script.get("width", 800), script.get("height", 600))
+    canvas.mUndoStack.setUndoLimit(1)
+    if "background" in script:
+        set_background(canvas, script["background"])
+    for operation in script.get("operations", []):
+        run_operation(canvas, operation)
+    canvas.finish_stroke()
+    canvas.sync()
+    return canvas.composite.to_image()
+
+
+def render_file(path, output_dir, image_format):
+    start = time.perf_counter()
+    with open(path) as f:
+        script = json.load(f)
+    name = script.get("output") or os.path.splitext(os.path.basename(path))[0] + "." + image_format
+    output = os.path.join(output_dir, name)
+    if not render(script).save(output):
+        raise OSError("cannot write " + output)
+    return output, time.perf_counter() - start
+
+
+def collect(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(".json"):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render Desk stroke scripts to images without a display.")
+    parser.add_argument("scripts", nargs="+", help="script files or directories of *.json scripts")
+    parser.add_argument("-o", "--output-dir", default=".")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("-f", "--format", default="png", choices=["png", "jpg", "jpeg"])
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    failures = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        jobs = {pool.submit(render_file, path, args.output_dir, args.format): path for path in collect(args.scripts)}
+        for job in as_completed(jobs):
+            try:
+                output, elapsed = job.result()
+            except (OSError, ValueError, KeyError, IndexError, TypeError) as error:
+                failures += 1
+                print("%s: %s" % (jobs[job], error), file=sys.stderr)
+            else:
+                print("%s -> %s (%.1f ms)" % (jobs[job], output, elapsed * 1000))
+    print("%d scripts, %d failed, %.2f s" % (len(jobs), failures, time.perf_counter() - start))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import sys
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtCore import Qt, QPoint, QEvent, QT_VERSION_STR, PYQT_VERSION_STR
+from PyQt5.QtGui import QColor, QMouseEvent
+from PyQt5.QtWidgets import QApplication
+
+TOOLS = ["brush", "eraser", "line", "rectangle", "circle"]
+SIZES = ["800x600", "1920x1080", "3840x2160"]
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    result = {}
+    for name, q in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99)]:
+        result[name] = round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 4)
+    result["max"] = round(samples[-1] * 1000, 4)
+    result["mean"] = round(sum(samples) / len(samples) * 1000, 4)
+    return result
+
+
+def synthetic_script(width, height, events, seed, stroke_length=50):
+    rnd = random.Random(seed)
+    strokes = []
+    while events > 0:
+        x, y = rnd.randrange(width), rnd.randrange(height)
+        stroke = [[x, y]]
+        for i in range(min(stroke_length, events) - 1):
+            x = min(max(x + rnd.randint(-15, 15), 0), width - 1)
+            y = min(max(y + rnd.randint(-15, 15), 0), height - 1)
+            stroke.append([x, y])
+        strokes.append(stroke)
+        events -= len(stroke)
+    return {"strokes": strokes}
+
+
+def undo_bytes(desk):
+    return sum(desk.mUndoStack.command(i).byte_count() for i in range(desk.mUndoStack.count()))
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def mouse_event(kind, x, y):
+    button = Qt.NoButton if kind == QEvent.MouseMove else Qt.LeftButton
+    buttons = Qt.NoButton if kind == QEvent.MouseButtonRelease else Qt.LeftButton
+    return QMouseEvent(kind, QPoint(x + 160, y + 90), button, buttons, Qt.NoModifier)
+
+
+def timed(samples, function, *args):
+    start = time.perf_counter()
+    function(*args)
+    samples.append(time.perf_counter() - start)
+
+
+def reset_canvas(app, desk, width, height):
+    desk.canvas.new(width, height)
+    desk.mUndoStack.clear()
+    desk.resize(width + 200, height + 160)
+    app.processEvents()
+
+
+def run_tool(app, desk, tool, width, height, script, frame_events):
+    reset_canvas(app, desk, width, height)
+    desk.canvas.instrument = tool
+    samples = {"press": [], "move": [], "release": [], "frame": []}
+    count = 0
+    start = time.perf_counter()
+    for stroke in script["strokes"]:
+        timed(samples["press"], desk.mousePressEvent, mouse_event(QEvent.MouseButtonPress, *stroke[0]))
+        for i, point in enumerate(stroke[1:]):
+            timed(samples["move"], desk.mouseMoveEvent, mouse_event(QEvent.MouseMove, *point))
+            if (i + 1) % frame_events == 0:
+                timed(samples["frame"], app.processEvents)
+        timed(samples["release"], desk.mouseReleaseEvent, mouse_event(QEvent.MouseButtonRelease, *stroke[-1]))
+        timed(samples["frame"], app.processEvents)
+        count += len(stroke) + 1
+    elapsed = time.perf_counter() - start
+    return {"tool": tool, "size": "%dx%d" % (width, height), "events": count,
+            "latency_ms": {name: percentiles(values) for name, values in samples.items()},
+            "throughput_events_per_s": round(count / elapsed, 1),
+            "undo_bytes": undo_bytes(desk), "undo_commands": desk.mUndoStack.count(),
+            "peak_rss_kb": peak_rss_kb()}
+
+
+def run_operations(app, desk, width, height, repeat):
+    reset_canvas(app, desk, width, height)
+    samples = {"light_checkered": [], "dark_lined": [], "clearing": [], "undo": [], "redo": [], "result": []}
+    for i in range(repeat):
+        timed(samples["light_checkered"], desk.canvas.set_background, QColor(255, 255, 255), "checkered")
+        timed(samples["dark_lined"], desk.canvas.set_background, QColor(100, 150, 100), "lined")
+        timed(samples["clearing"], desk.clearing)
+        timed(samples["undo"], desk.mUndoStack.undo)
+        timed(samples["redo"], desk.mUndoStack.redo)
+        desk.new_width, desk.new_height, desk.aspect = width // 2, height // 2, False
+        timed(samples["result"], desk.result)
+        desk.mUndoStack.undo()
+    app.processEvents()
+    return {"size": "%dx%d" % (width, height), "repeat": repeat,
+            "latency_ms": {name: percentiles(values) for name, values in samples.items()},
+            "undo_bytes": undo_bytes(desk), "peak_rss_kb": peak_rss_kb()}
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    old = {(r.get("tool", "operations"), r["size"]): r for r in baseline["results"] + baseline["operations"]}
+    for row in results["results"] + results["operations"]:
+        key = (row.get("tool", "operations"), row["size"])
+        if key not in old:
+            continue
+        for phase, stats in row["latency_ms"].items():
+            before = old[key]["latency_ms"].get(phase, {}).get("p50")
+            if before and stats:
+                ratio = stats["p50"] / before
+                mark = "  REGRESSION" if ratio > 1.1 else ""
+                print("%-10s %-10s %-16s p50 %8.3f -> %8.3f ms (x%.2f)%s" %
+                      (key[0], key[1], phase, before, stats["p50"], ratio, mark))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay mouse-event scripts into Desk and measure the drawing paths.")
+    parser.add_argument("--tools", nargs="+", default=TOOLS, choices=TOOLS)
+    parser.add_argument("--sizes", nargs="+", default=SIZES, help="canvas sizes as WIDTHxHEIGHT")
+    parser.add_argument("--events", type=int, default=2000, help="events per synthetic script")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--brush", default="Hard round", help="brush for the brush and eraser strokes")
+    parser.add_argument("--frame-events", type=int, default=4, help="move events delivered per frame")
+    parser.add_argument("--repeat", type=int, default=10, help="repetitions of the whole-canvas operations")
+    parser.add_argument("--script", help="recorded script: JSON object with a list of strokes of [x, y] points")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="earlier output file to compare against")
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    start = time.perf_counter()
+    from Desk import Desk
+    imported = time.perf_counter() - start
+    desk = Desk()
+    desk.brush_style.setCurrentText(args.brush)
+    desk.show()
+    app.processEvents()
+    startup = dict([("import", round(imported * 1000, 2))] + desk.startup)
+    print("startup " + ", ".join("%s %.1f ms" % phase for phase in startup.items()))
+    recorded = None
+    if args.script:
+        with open(args.script) as f:
+            recorded = json.load(f)
+
+    results = {"meta": {"python": platform.python_version(), "qt": QT_VERSION_STR, "pyqt": PYQT_VERSION_STR,
+                        "platform": platform.platform(), "seed": args.seed, "events": args.events, "brush": args.brush,
+                        "frame_events": args.frame_events, "script": args.script},
+               "startup_ms": startup, "results": [], "operations": []}
+    for size in args.sizes:
+        width, height = (int(v) for v in size.lower().split("x"))
+        script = recorded or synthetic_script(width, height, args.events, args.seed)
+        for tool in args.tools:
+            row = run_tool(app, desk, tool, width, height, script, args.frame_events)
+            results["results"].append(row)
+            print("%-10s %-10s move p50 %.3f ms, p99 %.3f ms, %.0f ev/s, undo %.1f MB" %
+                  (tool, row["size"], row["latency_ms"]["move"]["p50"], row["latency_ms"]["move"]["p99"],
+                   row["throughput_events_per_s"], row["undo_bytes"] / 2 ** 20))
+        results["operations"].append(run_operations(app, desk, width, height, args.repeat))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import math
+import random
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QPointF
+from PyQt5.QtGui import QImage, QPainter, QColor, QBrush, QRadialGradient
+
+DAB_CACHE_SIZE = 128
+GRAIN_SIZE = 64
+TEXTURES = ["", "grain"]
+
+
+class Brush:
+    # How the brush and eraser lay paint. Hardness 1 is the plain round pen; lower fades the dab edge from
+    # hardness * radius outwards. Spacing is the distance between dabs as a fraction of the size, pressure
+    # scales the dab size with tablet pressure and texture breaks the dab up with a grain.
+    def __init__(self, hardness=1.0, spacing=0.1, pressure=False, texture=""):
+        self.hardness, self.spacing, self.pressure, self.texture = hardness, spacing, pressure, texture
+
+    def stamped(self):
+        # Only the plain hard brush is drawn as pen lines.
+        return self.hardness < 1 or self.pressure or bool(self.texture)
+
+    def size_at(self, size, pressure):
+        return max(1, round(size * pressure)) if self.pressure else size
+
+
+BRUSHES = {"Hard round": Brush(),
+           "Soft round": Brush(0.3, 0.1),
+           "Airbrush": Brush(0.0, 0.05),
+           "Pencil": Brush(0.9, 0.15, True, "grain"),
+           "Chalk": Brush(0.5, 0.25, True, "grain")}
+
+
+def grain():
+    data = bytes(random.Random(GRAIN_SIZE).randrange(96, 256) for _ in range(GRAIN_SIZE * GRAIN_SIZE))
+    return QImage(data, GRAIN_SIZE, GRAIN_SIZE, GRAIN_SIZE, QImage.Format_Alpha8).copy()
+
+
+class DabCache:
+    # Dabs rendered once per size, colour, hardness and texture; the least recently used go past the limit.
+    def __init__(self, limit=DAB_CACHE_SIZE):
+        self.dabs, self.limit, self.textures = OrderedDict(), limit, {}
+
+    def dab(self, size, color, hardness, texture=""):
+        key = size, color.rgba(), hardness, texture
+        dab = self.dabs.get(key)
+        if dab is None:
+            dab = self.dabs[key] = self.render(size, color, hardness, texture)
+            if len(self.dabs) > self.limit:
+                self.dabs.popitem(last=False)
+        else:
+            self.dabs.move_to_end(key)
+        return dab
+
+    def render(self, size, color, hardness, texture):
+        side = size + 2
+        dab = QImage(side, side, QImage.Format_ARGB32_Premultiplied)
+        dab.fill(Qt.transparent)
+        painter = QPainter(dab)
+        painter.setRenderHint(QPainter.Antialiasing)
+        edge = QColor(color)
+        edge.setAlpha(0)
+        gradient = QRadialGradient(side / 2, side / 2, size / 2)
+        gradient.setColorAt(0, color)
+        gradient.setColorAt(hardness, color)
+        gradient.setColorAt(1, edge)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QBrush(gradient))
+        painter.drawEllipse(QPointF(side / 2, side / 2), size / 2, size / 2)
+        if texture:
+            if texture not in self.textures:
+                self.textures[texture] = grain()
+            painter.setCompositionMode(QPainter.CompositionMode_DestinationIn)
+            painter.fillRect(dab.rect(), QBrush(self.textures[texture]))
+        painter.end()
+        return dab
+
+
+DABS = DabCache()
+
+
+def dab_positions(points, step, carry=0.0):
+    # Dab centres every step along the (x, y, pressure) points, with pressure interpolated; carry is how far
+    # past the last dab the previous run ended and the second value returned is the same for this run.
+    dabs = []
+    for (x1, y1, p1), (x2, y2, p2) in zip(points, points[1:]):
+        length = math.hypot(x2 - x1, y2 - y1)
+        if not length:
+            continue
+        distance = step - carry
+        while distance <= length:
+            t = distance / length
+            dabs.append((round(x1 + t * (x2 - x1)), round(y1 + t * (y2 - y1)), p1 + t * (p2 - p1)))
+            distance += step
+        carry = length - (distance - step)
+    return dabs, carry
+
+
+def paint_dabs(painter, stamps):
+    for x, y, dab in stamps:
+        painter.drawImage(x, y, dab)
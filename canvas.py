@@ -0,0 +1,712 @@
+from PyQt5.QtCore import Qt, QPoint, QRect, QSize, QTimer, QObject, QCoreApplication, pyqtSignal
+from PyQt5.QtGui import QPainter, QImage, QColor, QPen, QBrush, QPolygon, QImageReader
+from PyQt5.QtWidgets import QUndoCommand, QUndoStack
+
+from brushes import BRUSHES, DABS, dab_positions, paint_dabs
+from render import Renderer
+from shapes import Shape, ShapeLayer, stroke_rect, segment_rects, paint_shape, paint_region
+from tiles import TiledImage, Composite, TILE_SIZE, TILE_BYTES, tile_rect, tile_keys, scaled_base, solid_tile, \
+    store_tile, load_tile
+
+UNDO_MEMORY_LIMIT = 256 * 1024 * 1024
+TRANSPARENT = QColor(0, 0, 0, 0)
+
+
+def rescaled(background, image, source, size, smooth=True):
+    # The layers resampled to size; an opened file nobody has drawn on is decoded again at that size instead.
+    if source is not None:
+        return TiledImage.from_image(source.read(size=size)), TiledImage(size.width(), size.height(), TRANSPARENT)
+    sx, sy = size.width() / image.width(), size.height() / image.height()
+    if background.allocated() or isinstance(background.base, TiledImage):
+        background = background.scaled(size.width(), size.height(), QColor(255, 255, 255), smooth)
+    else:
+        background = TiledImage(size.width(), size.height(), scaled_base(background.base, sx, sy))
+    return background, image.scaled(size.width(), size.height(), TRANSPARENT, smooth)
+
+
+class UndoCommand(QUndoCommand):
+    # Strokes keep only the tiles they touched (filters those of the background too), whole-canvas operations
+    # keep a full snapshot.
+    # Saved tiles share pixels with the canvas until it paints over them; None means "not allocated".
+    # While the document is inactive they may be compressed or spilled (see store_tile).
+    def __init__(self, parent, tiled=False):
+        super().__init__()
+        self.parent = parent
+        self.mPrevTiles, self.mCurrTiles = {}, {}
+        self.mPrevBackgroundTiles, self.mCurrBackgroundTiles = {}, {}
+        self.mPrevImage = None if tiled else parent.image.snapshot()
+        self.mPrevBackground = None if tiled else parent.background.snapshot()
+        self.mPrevShapes = None if tiled else parent.shapes
+        self.mCurrImage, self.mCurrBackground, self.mCurrShapes = None, None, None
+
+    def touch(self, rect, background=False):
+        self.touch_keys(tile_keys(rect, self.parent.image.rect()), background)
+
+    def touch_keys(self, keys, background=False):
+        layer = self.parent.background if background else self.parent.image
+        saved = self.mPrevBackgroundTiles if background else self.mPrevTiles
+        for key in keys:
+            if key not in saved:
+                saved[key] = layer.shared(key)
+
+    def tile_sets(self):
+        return [self.mPrevTiles, self.mCurrTiles, self.mPrevBackgroundTiles, self.mCurrBackgroundTiles]
+
+    def byte_count(self):
+        tiles = [tile for tiles in self.tile_sets() for tile in tiles.values()]
+        return (TILE_BYTES * sum(isinstance(tile, QImage) for tile in tiles) +
+                sum(len(tile) for tile in tiles if isinstance(tile, bytes)) +
+                sum(image.byte_count() for image in [self.mPrevImage, self.mCurrImage] if image is not None))
+
+    def release(self):
+        self.mPrevTiles, self.mCurrTiles = {}, {}
+        self.mPrevBackgroundTiles, self.mCurrBackgroundTiles = {}, {}
+        self.mPrevImage, self.mCurrImage = None, None
+        self.mPrevBackground, self.mCurrBackground = None, None
+        self.mPrevShapes, self.mCurrShapes = None, None
+
+    def compress(self, spill=False):
+        for tiles in self.tile_sets():
+            for key, tile in tiles.items():
+                tiles[key] = store_tile(tile, spill)
+        images = [self.mPrevImage, self.mCurrImage, self.mPrevBackground, self.mCurrBackground]
+        images += [shapes.raster for shapes in [self.mPrevShapes, self.mCurrShapes] if shapes is not None]
+        for image in images:
+            if image is not None:
+                image.compress(spill)
+
+    def restore_tiles(self, layer, tiles, saved=None):
+        if saved is not None:
+            for key in tiles:
+                saved[key] = layer.shared(key)
+        damage = QRect()
+        for key, tile in tiles.items():
+            layer.set(key, load_tile(tile))
+            damage = damage.united(tile_rect(key))
+        self.parent.mark_dirty(damage)
+
+    def undo(self):
+        self.parent.finish_stroke()
+        self.parent.sync()
+        if self.mPrevImage is not None:
+            self.mCurrImage, self.mCurrBackground = self.parent.image.snapshot(), self.parent.background.snapshot()
+            self.mCurrShapes = self.parent.shapes
+            self.parent.image, self.parent.background = self.mPrevImage, self.mPrevBackground
+            self.parent.shapes = self.mPrevShapes
+            self.parent.update()
+            self.parent.record("undo_redo", self.parent, None)
+        else:
+            self.restore_tiles(self.parent.image, self.mPrevTiles, self.mCurrTiles)
+            self.restore_tiles(self.parent.background, self.mPrevBackgroundTiles, self.mCurrBackgroundTiles)
+            self.parent.record("undo_redo", self.parent, list(self.mPrevTiles), list(self.mPrevBackgroundTiles))
+
+    def redo(self):
+        self.parent.finish_stroke()
+        self.parent.sync()
+        if self.mCurrImage is not None:
+            self.parent.image, self.parent.background = self.mCurrImage, self.mCurrBackground
+            self.parent.shapes = self.mCurrShapes
+            self.parent.update()
+            self.parent.record("undo_redo", self.parent, None)
+        elif self.mCurrTiles or self.mCurrBackgroundTiles:
+            self.restore_tiles(self.parent.image, self.mCurrTiles)
+            self.restore_tiles(self.parent.background, self.mCurrBackgroundTiles)
+            self.parent.record("undo_redo", self.parent, list(self.mCurrTiles), list(self.mCurrBackgroundTiles))
+
+
+class ShapeCommand(QUndoCommand):
+    # Adding, editing or deleting one shape; only the shapes change hands, never pixels.
+    def __init__(self, parent, z, before, after):
+        super().__init__()
+        self.parent, self.z, self.before, self.after = parent, z, before, after
+
+    def byte_count(self):
+        return 0
+
+    def release(self):
+        pass
+
+    def compress(self, spill=False):
+        pass
+
+    def undo(self):
+        self.parent.finish_stroke()
+        self.parent.replace_shape(self.z, self.before)
+
+    def redo(self):
+        self.parent.finish_stroke()
+        self.z = self.parent.replace_shape(self.z, self.after)
+
+
+COLORS = {"Pink": QColor(255, 100, 150), "Red": QColor(255, 0, 0), "Orange": QColor(255, 150, 0),
+          "Yellow": QColor(255, 255, 0), "Green": QColor(0, 255, 0), "Light blue": QColor(0, 255, 255),
+          "Blue": QColor(0, 0, 255), "Violet": QColor(150, 0, 255), "Brown": QColor(150, 75, 0),
+          "Grey": QColor(100, 100, 100), "White": QColor(255, 255, 255), "Black": QColor(0, 0, 0)}
+
+BACKGROUNDS = {"White": (QColor(255, 255, 255), ""),
+               "Light checkered": (QColor(255, 255, 255), "checkered"),
+               "Dark checkered": (QColor(100, 150, 100), "checkered"),
+               "Light lined": (QColor(255, 255, 255), "lined"),
+               "Dark lined": (QColor(100, 150, 100), "lined")}
+BACKGROUNDS.update((name, (color, "")) for name, color in COLORS.items() if name != "White")
+
+PATTERN_TILES = {}
+
+
+def pattern_tile(style, color):
+    # One period of the checkered/lined background, rendered once and used as a texture brush.
+    if (style, color) not in PATTERN_TILES:
+        step = 45 if style == "checkered" else 60
+        tile = QImage(step, step, QImage.Format_ARGB32)
+        if color == "light":
+            tile.fill(QColor(255, 255, 255))
+            pen = QPen(QColor(0, 150, 150), 3, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+        else:
+            tile.fill(QColor(100, 150, 100))
+            pen = QPen(QColor(255, 255, 255), 3, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+        painter = QPainter(tile)
+        painter.setPen(pen)
+        for offset in (0, step):
+            painter.drawLine(-step, offset, 2 * step, offset)
+            if style == "checkered":
+                painter.drawLine(offset, -step, offset, 2 * step)
+        painter.end()
+        PATTERN_TILES[(style, color)] = tile
+    return PATTERN_TILES[(style, color)]
+
+
+class SourceImage:
+    # Opened file kept as a lazy handle: pixels are decoded on demand, scaled by the reader.
+    def __init__(self, path):
+        self.path = path
+        reader = QImageReader(path)
+        self.size = reader.size()
+        if not self.size.isValid():
+            raise OSError("%s: %s" % (path, reader.errorString()))
+
+    def read(self, size=None):
+        reader = QImageReader(self.path)
+        if size is not None:
+            reader.setScaledSize(size)
+        image = reader.read()
+        if image.isNull():
+            raise OSError("%s: %s" % (self.path, reader.errorString()))
+        return image
+
+    def fitted(self, bounds):
+        if self.size.width() <= bounds.width() and self.size.height() <= bounds.height():
+            return QSize(self.size)
+        return self.size.scaled(bounds, Qt.KeepAspectRatio)
+
+
+class Canvas(QObject):
+    # Document state and tools without any widget; changed carries damage in image coordinates,
+    # a null rect means the whole canvas (including its size) changed.
+    changed = pyqtSignal(QRect)
+    rendered = pyqtSignal()
+
+    def __init__(self, width, height, parent=None):
+        super().__init__(parent)
+        self.mUndoStack = QUndoStack(self)
+        self.mUndoStack.indexChanged.connect(self.drop_released)
+        self.dropping = False
+        self.undo_command, self.journal = None, None
+        self.now_background = QColor(255, 255, 255)
+        self.background = TiledImage(width, height, self.now_background)
+        self.image = TiledImage(width, height, TRANSPARENT)
+        self.shapes = ShapeLayer(width, height)
+        self.composite = Composite([self.background, self.image, self.shapes.raster])
+        self.checkered_or_lined = ""
+        self.source, self.source_index = None, -1
+        self.start_pos, self.preview, self.stroke_log = (0, 0), None, []
+        self.stroke_keys, self.stroke_points, self.start_pressure, self.dab_carry = set(), [], 1.0, 0.0
+        self.renderer = Renderer(self.rendered.emit, QCoreApplication.instance() is not None)
+        self.rendered.connect(self.collect)
+        self.stroke_timer = QTimer(self)
+        self.stroke_timer.setSingleShot(True)
+        self.stroke_timer.setInterval(0)
+        self.stroke_timer.timeout.connect(self.flush_stroke)
+        self.now_size, self.now_color, self.drawing, self.size = None, None, False, 3
+        self.fill_color, self.instrument, self.tolerance = "transparent", "brush", 32
+        self.brush, self.opacity = BRUSHES["Hard round"], 1.0
+        self.selection, self.picked, self.drag = None, None, (0, 0)
+        self.brush_color = QColor(0, 0, 0)
+
+    def mark_dirty(self, rect):
+        self.composite.invalidate(rect)
+        self.changed.emit(rect)
+
+    def mark_overlay(self, rect):
+        self.changed.emit(rect)
+
+    def update(self):
+        self.composite.layers = [self.background, self.image, self.shapes.raster]
+        self.composite.invalidate(QRect())
+        self.changed.emit(QRect())
+
+    def record(self, name, *args):
+        if self.journal:
+            getattr(self.journal, name)(*args)
+
+    def restore_rect(self, rect, image, background=False):
+        def paste(painter):
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            painter.drawImage(rect.topLeft(), image)
+        self.sync()
+        (self.background if background else self.image).draw([rect], paste)
+        self.mark_dirty(rect)
+
+    def collect(self):
+        damage = QRect()
+        for (layer, key), tile in self.renderer.take().items():
+            layer.set(key, tile)
+            damage = damage.united(tile_rect(key))
+        if not damage.isNull():
+            self.image.trim()
+            self.mark_dirty(damage)
+
+    def sync(self):
+        # Waits for the render thread and takes in everything it painted; anything that reads or replaces
+        # a layer calls this first.
+        self.renderer.wait()
+        self.collect()
+
+    def render(self, keys, function, layer=None):
+        # The first time a stroke reaches a tile the render thread gets its own copy of it.
+        layer = self.image if layer is None else layer
+        tiles = {key: QImage(layer.tile(key)) for key in keys if (layer, key) not in self.stroke_keys}
+        self.stroke_keys.update((layer, key) for key in tiles)
+        self.renderer.submit(self.renderer.paint, layer, keys, tiles, function)
+
+    def make_undo_command(self, tiled=False):
+        self.sync()
+        self.undo_command = UndoCommand(self, tiled)
+        self.mUndoStack.push(self.undo_command)
+        if not tiled:
+            self.trim_undo_stack()
+
+    def memory(self):
+        undo = sum(self.mUndoStack.command(i).byte_count() for i in range(self.mUndoStack.count()))
+        layers = sum(layer.byte_count() for layer in [self.background, self.image, self.shapes.raster])
+        return undo + layers + len(self.composite.tiles) * TILE_BYTES
+
+    def compress(self, spill=False):
+        # For a document in the background: the flattened tiles are dropped and every layer and undo tile
+        # leaves RAM, compressed or (spill) on disk, until something reads it again.
+        self.finish_stroke()
+        self.sync()
+        self.composite.invalidate(QRect())
+        for layer in [self.background, self.image, self.shapes.raster]:
+            layer.compress(spill)
+        for i in range(self.mUndoStack.count()):
+            self.mUndoStack.command(i).compress(spill)
+
+    def clear_history(self):
+        # An opened file still counts as unedited afterwards only if nothing was done to it since.
+        pristine = self.source is not None and self.mUndoStack.index() == self.source_index
+        self.mUndoStack.clear()
+        self.source_index = 0 if pristine else -1
+
+    def close(self):
+        self.finish_stroke()
+        self.sync()
+        self.renderer.shutdown()
+        self.mUndoStack.clear()
+
+    def trim_undo_stack(self):
+        # Over the budget the oldest commands are released. A released command and everything below it can
+        # no longer be undone, so they are marked obsolete and leave the stack once the index reaches them.
+        commands = [self.mUndoStack.command(i) for i in range(self.mUndoStack.count())]
+        total = sum(command.byte_count() for command in commands)
+        released = 0
+        for i, command in enumerate(commands[:-1]):
+            if total <= UNDO_MEMORY_LIMIT:
+                break
+            total -= command.byte_count()
+            released = i + 1
+        for command in commands[:released]:
+            command.release()
+            command.setObsolete(True)
+
+    def drop_released(self, index):
+        if self.dropping:
+            return
+        self.dropping = True
+        while index and self.mUndoStack.command(index - 1).isObsolete():
+            self.mUndoStack.undo()
+            index = self.mUndoStack.index()
+        self.dropping = False
+
+    def draw_shape(self, painter, start_pos, end_pos):
+        paint_shape(painter, self.instrument, self.now_color, self.now_size, self.fill_color, start_pos, end_pos)
+
+    def replace_shape(self, z, shape):
+        # Only the tiles under the old and the new shape are painted again, each with the shapes over it.
+        self.sync()
+        if self.picked == z and shape is None:
+            self.pick(None)
+        old = self.shapes.shapes.get(z)
+        z = self.shapes.replace(z, shape)
+        keys = set()
+        for changed in [old, shape]:
+            if changed is not None:
+                for rect in changed.rects():
+                    keys.update(tile_keys(rect, self.image.rect()))
+        self.renderer.submit(self.renderer.begin, None, False)
+        for key in keys:
+            shapes = self.shapes.query(tile_rect(key))
+            if shapes:
+                self.render([key], lambda painter, shapes=shapes, key=key: paint_region(painter, shapes, tile_rect(key)),
+                            self.shapes.raster)
+            else:
+                self.shapes.raster.set(key, None)
+                self.mark_dirty(tile_rect(key))
+        self.renderer.submit(self.renderer.end)
+        self.stroke_keys = set()
+        self.record("shape", self, z, shape)
+        return z
+
+    def pick(self, z):
+        for picked in [self.picked, z]:
+            if picked is not None and picked in self.shapes.shapes:
+                self.mark_overlay(self.shapes.shapes[picked].bounds().adjusted(-2, -2, 2, 2))
+        self.picked, self.drag = z, (0, 0)
+
+    def edit_picked(self, shape):
+        if self.picked in self.shapes.shapes:
+            self.mUndoStack.push(ShapeCommand(self, self.picked, self.shapes.shapes[self.picked], shape))
+            self.trim_undo_stack()
+
+    def restyle_picked(self):
+        if self.picked in self.shapes.shapes:
+            self.edit_picked(self.shapes.shapes[self.picked].restyled(self.brush_color, self.size, self.fill_color))
+
+    def delete_picked(self):
+        self.edit_picked(None)
+
+    def draw_preview(self, painter):
+        if self.preview:
+            painter.setClipRect(self.image.rect())
+            self.draw_shape(painter, *self.preview)
+        if self.selection is not None:
+            painter.setPen(QPen(QColor(0, 120, 215), 0, Qt.DashLine))
+            painter.setBrush(Qt.NoBrush)
+            painter.drawRect(self.selection.adjusted(0, 0, -1, -1))
+        if self.picked is not None and self.picked in self.shapes.shapes:
+            shape = self.shapes.shapes[self.picked].moved(*self.drag)
+            if self.drag != (0, 0):
+                painter.save()
+                painter.setOpacity(0.5)
+                shape.paint(painter)
+                painter.restore()
+            painter.setPen(QPen(QColor(0, 120, 215), 0, Qt.DashLine))
+            painter.setBrush(Qt.NoBrush)
+            painter.drawRect(shape.bounds())
+
+    def select(self, rect):
+        if self.selection is not None:
+            self.mark_overlay(self.selection.adjusted(-1, -1, 1, 1))
+        self.selection = None if rect is None else rect.normalized().intersected(self.image.rect())
+        if self.selection is not None and self.selection.isEmpty():
+            self.selection = None
+        if self.selection is not None:
+            self.mark_overlay(self.selection.adjusted(-1, -1, 1, 1))
+
+    def press(self, x, y, pressure=1.0):
+        if self.instrument == "bucket":
+            self.bucket_fill(x, y)
+            return
+        if self.instrument == "select":
+            self.select(None)
+            self.start_pos, self.drawing = (x, y), True
+            return
+        if self.instrument == "pick":
+            self.pick(self.shapes.at(x, y))
+            self.start_pos, self.drawing = (x, y), self.picked is not None
+            return
+        if self.instrument in ["brush", "eraser"]:
+            self.make_undo_command(tiled=True)
+        self.start_pos, self.stroke_log = (x, y), [(x, y, pressure)]
+        self.start_pressure, self.dab_carry = pressure, 0.0
+        self.drawing = True
+        if self.instrument == "eraser":
+            # Only the alpha of what the eraser paints counts.
+            self.now_color = QColor(0, 0, 0)
+            self.now_size = self.size * 2
+        else:
+            self.now_color = self.brush_color
+            self.now_size = self.size
+
+        if self.instrument in ["brush", "eraser"]:
+            # The render thread keeps painters open on every tile the stroke reaches until it ends; the
+            # eraser clears the drawing layer so the background shows through. Soft, textured and pressure
+            # brushes stamp cached dabs instead of drawing pen lines, always through a stroke mask.
+            damage = stroke_rect(x, y, x, y, self.now_size)
+            self.undo_command.touch(damage)
+            pen = QPen(self.now_color, self.now_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+            masked = self.brush.stamped() or self.opacity < 1
+            self.renderer.submit(self.renderer.begin, pen, self.instrument == "eraser",
+                                 self.opacity if masked else None)
+            if self.brush.stamped():
+                self.stamp([(x, y, pressure)])
+            else:
+                self.render(tile_keys(damage, self.image.rect()), lambda painter: painter.drawPoint(x, y))
+
+    def stamp(self, dabs):
+        # Each tile gets only the dabs that reach it; a dab is at most a tile wide, so it reaches two columns
+        # and rows of tiles at most.
+        stamps, sized = {}, {}
+        width, height = self.image.width(), self.image.height()
+        for x, y, pressure in dabs:
+            size = self.brush.size_at(self.now_size, pressure)
+            dab = sized.get(size)
+            if dab is None:
+                dab = sized[size] = DABS.dab(size, self.now_color, self.brush.hardness, self.brush.texture)
+            left, top = x - dab.width() // 2, y - dab.height() // 2
+            columns = range(max(0, left) // TILE_SIZE, min(width - 1, left + dab.width() - 1) // TILE_SIZE + 1)
+            for row in range(max(0, top) // TILE_SIZE, min(height - 1, top + dab.height() - 1) // TILE_SIZE + 1):
+                for column in columns:
+                    stamps.setdefault((column, row), []).append((left, top, dab))
+        for key, placed in stamps.items():
+            self.render([key], lambda painter, placed=placed: paint_dabs(painter, placed))
+
+    def move(self, x, y, pressure=1.0):
+        if not self.drawing:
+            return
+        end_pos = (x, y)
+        if self.instrument == "select":
+            self.select(QRect(QPoint(*self.start_pos), QPoint(*end_pos)))
+            return
+        if self.instrument == "pick":
+            bounds = self.shapes.shapes[self.picked].bounds()
+            self.mark_overlay(bounds.translated(*self.drag).adjusted(-2, -2, 2, 2))
+            self.drag = (x - self.start_pos[0], y - self.start_pos[1])
+            self.mark_overlay(bounds.translated(*self.drag).adjusted(-2, -2, 2, 2))
+            return
+        damage = stroke_rect(*self.start_pos, *end_pos, self.now_size)
+        if self.instrument in ["brush", "eraser"]:
+            last = self.stroke_points[-1][:2] if self.stroke_points else self.start_pos
+            for rect in segment_rects(*last, *end_pos, self.now_size):
+                self.undo_command.touch(rect)
+            self.stroke_points.append((x, y, pressure))
+            self.stroke_log.append((x, y, pressure))
+            if QCoreApplication.instance():
+                self.stroke_timer.start()
+        elif self.instrument in ["line", "rectangle", "circle"]:
+            if self.preview:
+                self.mark_overlay(stroke_rect(*self.preview[0], *self.preview[1], self.now_size))
+            self.preview = (self.start_pos, end_pos)
+            self.mark_overlay(damage)
+
+    def flush_stroke(self):
+        if self.stroke_points:
+            points = [(*self.start_pos, self.start_pressure)] + self.stroke_points
+            if self.brush.stamped():
+                step = max(1.0, self.brush.spacing * self.now_size)
+                dabs, self.dab_carry = dab_positions(points, step, self.dab_carry)
+                self.stamp(dabs)
+            else:
+                keys = set()
+                for (x1, y1, _), (x2, y2, _) in zip(points, points[1:]):
+                    for rect in segment_rects(x1, y1, x2, y2, self.now_size):
+                        keys.update(tile_keys(rect, self.image.rect()))
+                polygon = QPolygon([QPoint(x, y) for x, y, _ in points])
+                self.render(keys, lambda painter: painter.drawPolyline(polygon))
+            self.start_pos, self.start_pressure = self.stroke_points[-1][:2], self.stroke_points[-1][2]
+            self.stroke_points = []
+
+    def finish_stroke(self):
+        if self.drawing and self.instrument in ["brush", "eraser"]:
+            self.flush_stroke()
+            self.stroke_timer.stop()
+            self.renderer.submit(self.renderer.end)
+            self.stroke_keys = set()
+            self.drawing = False
+            self.image.trim()
+
+    def release(self):
+        if not self.drawing:
+            return
+        self.finish_stroke()
+        self.drawing = False
+        if self.instrument == "select":
+            return
+        if self.instrument == "pick":
+            if self.drag != (0, 0):
+                shape = self.shapes.shapes[self.picked].moved(*self.drag)
+                self.pick(self.picked)
+                self.edit_picked(shape)
+                self.pick(self.picked)
+            return
+        if self.preview:
+            # Shapes stay editable on the shape layer instead of being painted into the drawing.
+            self.mark_overlay(stroke_rect(*self.preview[0], *self.preview[1], self.now_size))
+            shape = Shape(self.instrument, *self.preview, self.now_color, self.now_size, self.fill_color)
+            self.preview = None
+            self.mUndoStack.push(ShapeCommand(self, None, None, shape))
+        elif self.instrument in ["brush", "eraser"]:
+            self.record("stroke", self, self.stroke_log)
+        self.trim_undo_stack()
+
+    def bucket_fill(self, x, y):
+        if not self.image.rect().contains(x, y):
+            return
+        import pixels  # NumPy is loaded on first use, it would be most of the startup time
+        self.sync()
+        # Only tiles some layer has painted can differ from the background's colour; of those, the ones an
+        # earlier fill left solid are still matched without reading them.
+        base = self.background.base.rgba() if isinstance(self.background.base, QColor) else None
+        keys = set(tile_keys(self.image.rect(), self.image.rect())) if base is None else set()
+        for layer in self.composite.layers:
+            keys.update(layer.allocated())
+        colors = {key: self.composite.solid_color(key) for key in keys}
+        filled = list(pixels.flood(self.image.width(), self.image.height(), base, colors, self.composite.tile,
+                                   x, y, self.tolerance))
+        self.make_undo_command(tiled=True)
+        self.undo_command.touch_keys([key for key, _ in filled])
+        color, solid = self.brush_color.rgba(), solid_tile(self.brush_color)
+        for key, mask in filled:
+            if mask is None:
+                self.image.set(key, solid)
+            else:
+                pixels.view(self.image.writable(key))[mask] = color
+        columns, rows = [key[0] for key, _ in filled], [key[1] for key, _ in filled]
+        self.mark_dirty(QRect(min(columns) * TILE_SIZE, min(rows) * TILE_SIZE,
+                              (max(columns) + 1 - min(columns)) * TILE_SIZE,
+                              (max(rows) + 1 - min(rows)) * TILE_SIZE).intersected(self.image.rect()))
+        self.image.trim()
+        self.record("fill", self, x, y)
+        self.trim_undo_stack()
+
+    def revision(self):
+        # Moves with every edit, undo and redo: the index alone comes back after an undo and a new edit.
+        index = self.mUndoStack.index()
+        return index, self.mUndoStack.command(index - 1)
+
+    def filter_input(self, steps, rect=None):
+        # The region to filter (rect, else the selection, else the whole canvas), the area around it the
+        # steps read from, copies of that area of the background and the drawing, each filtered on its
+        # own (shapes stay vector above them), and the revision they were copied at.
+        import filters
+        self.finish_stroke()
+        self.sync()
+        rect = rect or self.selection or self.image.rect()
+        rect = rect.intersected(self.image.rect())
+        margin = filters.margin(steps)
+        area = rect.adjusted(-margin, -margin, margin, margin).intersected(self.image.rect())
+        return rect, area, [self.background.copy(area), self.image.copy(area)], self.revision()
+
+    def put_filtered(self, steps, rect, area, layers, revision=None):
+        # layers are the filtered pixels of the background and the drawing, in one undo step. They are
+        # dropped if the canvas was edited (or a stroke begun) since filter_input(): writing them would
+        # undo that edit. Returns whether they were applied.
+        if rect.isEmpty() or rect.size() != self.image.rect().intersected(rect).size():
+            return False
+        if revision is not None and (self.drawing or self.revision() != revision):
+            return False
+        import pixels
+        self.make_undo_command(tiled=True)
+        background, image = [values[rect.top() - area.top():rect.bottom() + 1 - area.top(),
+                                    rect.left() - area.left():rect.right() + 1 - area.left()] for values in layers]
+        # Fully transparent pixels go back to 0, so drawing tiles nobody painted stay unallocated.
+        pixels.clear_transparent(image)
+        pixels.write(self.background, rect, background, lambda part: self.undo_command.touch(part, True))
+        pixels.write(self.image, rect, image, self.undo_command.touch)
+        self.mark_dirty(rect)
+        self.background.trim()
+        self.image.trim()
+        self.record("filter", self, steps, rect)
+        self.trim_undo_stack()
+        return True
+
+    def apply_filter(self, steps, rect=None):
+        import filters
+        rect, area, layers, revision = self.filter_input(steps, rect)
+        if not rect.isEmpty():
+            self.put_filtered(steps, rect, area, [filters.run(layer, steps) for layer in layers], revision)
+
+    def new(self, width, height):
+        self.make_undo_command()
+        self.selection = None
+        self.now_background = QColor(255, 255, 255)
+        self.checkered_or_lined = ""
+        self.background = TiledImage(width, height, self.now_background)
+        self.image = TiledImage(width, height, TRANSPARENT)
+        self.shapes, self.picked = ShapeLayer(width, height), None
+        self.source = None
+        self.record("new", width, height)
+        self.update()
+
+    def load(self, source, image):
+        self.make_undo_command()
+        self.selection = None
+        self.source, self.source_index = source, self.mUndoStack.index()
+        self.background = TiledImage.from_image(image)
+        self.image = TiledImage(image.width(), image.height(), TRANSPARENT)
+        self.shapes, self.picked = ShapeLayer(image.width(), image.height()), None
+        self.record("open", source.path, image.size())
+        self.update()
+
+    def clear(self):
+        self.make_undo_command()
+        self.image = TiledImage(self.image.width(), self.image.height(), TRANSPARENT)
+        self.shapes, self.picked = ShapeLayer(self.image.width(), self.image.height()), None
+        self.record("clear")
+        self.update()
+
+    def rescale(self, width, height, aspect, smooth=True):
+        # Without smooth the layers get a quick nearest-neighbour preview; the returned arguments for
+        # rescaled() make the smooth version, which refine_rescale() swaps in.
+        pristine = self.source is not None and self.mUndoStack.index() == self.source_index
+        self.make_undo_command()
+        self.selection = None
+        size = (self.source.size if pristine else self.image.size()).scaled(
+            width, height, Qt.KeepAspectRatio if aspect else Qt.IgnoreAspectRatio)
+        layers = self.background.snapshot(), self.image.snapshot(), self.source if pristine else None, size
+        self.shapes = self.shapes.scaled(size.width(), size.height(), size.width() / self.image.width(),
+                                         size.height() / self.image.height())
+        if smooth:
+            self.background, self.image = rescaled(*layers)
+        else:
+            self.background, self.image = rescaled(self.background, self.image, None, size, False)
+        self.record("rescale", width, height, aspect, smooth)
+        self.update()
+        return layers
+
+    def refine_rescale(self, command, background, image):
+        # Nothing may have been drawn over the preview since: later commands keep tiles of it.
+        self.sync()
+        index = self.mUndoStack.index()
+        if index and self.mUndoStack.command(index - 1) is command:
+            self.background, self.image = background, image
+            self.record("undo_redo", self, None)
+            self.update()
+        elif command.mCurrImage is not None and \
+                any(self.mUndoStack.command(i) is command for i in range(index, self.mUndoStack.count())):
+            command.mCurrImage, command.mCurrBackground = image, background
+
+    def set_background(self, color, mode=""):
+        self.make_undo_command()
+        self.now_background = QColor(color)
+        shade = "light" if self.now_background == QColor(255, 255, 255) else "dark"
+        if mode == "checkered":
+            self.made_checkered(shade)
+        elif mode == "lined":
+            self.made_lined(shade)
+        else:
+            self.checkered_or_lined = ""
+            self.fill_background()
+        self.record("background", color, mode)
+        self.update()
+
+    def made_lined(self, color):
+        self.checkered_or_lined = "lined"
+        self.fill_background(QBrush(pattern_tile("lined", color)))
+
+    def made_checkered(self, color):
+        self.checkered_or_lined = "checkered"
+        self.fill_background(QBrush(pattern_tile("checkered", color)))
+
+    def fill_background(self, base=None):
+        width, height = self.image.width(), self.image.height()
+        self.background = TiledImage(width, height, QColor(self.now_background) if base is None else base)
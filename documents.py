@@ -0,0 +1,74 @@
+import os
+
+from PyQt5.QtCore import QPointF
+
+MEMORY_BUDGET = 512 * 1024 * 1024
+STATES = ["active", "compressed", "spilled"]
+TOOL_STATE = ["instrument", "brush_color", "size", "fill_color", "tolerance", "brush", "opacity"]
+
+
+class Document:
+    # One open picture: its canvas (with its own undo stack and recovery journal), the file it belongs to
+    # and how it was viewed.
+    def __init__(self, canvas, path=""):
+        self.canvas, self.path, self.journal = canvas, path, None
+        self.zoom, self.origin = 1.0, QPointF(160, 90)
+        self.state = "active"
+
+    def title(self):
+        title = os.path.basename(self.path) or "Untitled"
+        return title if self.canvas.mUndoStack.isClean() else title + " *"
+
+    def pristine(self):
+        return not self.path and not self.canvas.mUndoStack.count()
+
+
+class Documents:
+    # The open documents in tab order, and which was used last. Over the memory budget the inactive ones
+    # are compressed, least recently used first, then spilled to disk; their tiles come back into RAM
+    # one by one as they are read.
+    def __init__(self, budget=MEMORY_BUDGET):
+        self.documents, self.recent, self.budget = [], [], budget
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __getitem__(self, index):
+        return self.documents[index]
+
+    def index(self, document):
+        return self.documents.index(document)
+
+    def add(self, document):
+        self.documents.append(document)
+        self.recent.insert(0, document)
+
+    def remove(self, document):
+        self.documents.remove(document)
+        self.recent.remove(document)
+
+    def activate(self, document):
+        self.recent.remove(document)
+        self.recent.append(document)
+        document.state = "active"
+
+    def memory(self):
+        return sum(document.canvas.memory() for document in self.documents)
+
+    def enforce(self):
+        total = self.memory()
+        for state in STATES[1:]:
+            for document in self.recent[:-1]:
+                if total <= self.budget:
+                    return total
+                if STATES.index(document.state) < STATES.index(state):
+                    before = document.canvas.memory()
+                    document.canvas.compress(state == "spilled")
+                    document.state = state
+                    total -= before - document.canvas.memory()
+        return total
+
+
+def carry_tools(source, target):
+    for name in TOOL_STATE:
+        setattr(target, name, getattr(source, name))
@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+import tempfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from PyQt5.QtCore import Qt, QSaveFile, QIODevice
+from PyQt5.QtGui import QImage, QImageWriter, QPainter
+
+# format, compression (PNG zlib level 0-9), quality (JPEG 0-100), depth (bits per pixel: 8 is a palette,
+# 24 and 32 are 8 bits a channel, 64 is 16), alpha (False flattens onto white; JPEG and Qt's palettes
+# never have it) and scale.
+PRESETS = {"PNG, fast": {"format": "png", "compression": 1},
+           "PNG, small": {"format": "png", "compression": 9},
+           "PNG, palette": {"format": "png", "compression": 9, "depth": 8},
+           "PNG, 16-bit": {"format": "png", "compression": 6, "depth": 64},
+           "PNG, no alpha": {"format": "png", "compression": 6, "alpha": False},
+           "JPEG, print": {"format": "jpg", "quality": 95},
+           "JPEG, web": {"format": "jpg", "quality": 80},
+           "JPEG, thumbnail": {"format": "jpg", "quality": 75, "scale": 0.25}}
+FORMATS = {(8, False): QImage.Format_Indexed8,
+           (24, True): QImage.Format_RGB888, (24, False): QImage.Format_RGB888,
+           (32, True): QImage.Format_ARGB32, (32, False): QImage.Format_RGB32,
+           (64, True): QImage.Format_RGBA64, (64, False): QImage.Format_RGBX64}
+POOL = None
+
+
+def pool():
+    # Encoders run in processes of their own (started fresh, not forked from the threaded editor), kept for
+    # the next export.
+    global POOL
+    if POOL is None:
+        POOL = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+    return POOL
+
+
+def output_path(path, name, preset, several):
+    root, extension = os.path.splitext(path)
+    if several:
+        root += "-" + "".join(c if c.isalnum() else "-" for c in name.lower()).replace("--", "-")
+    return root + (extension if extension[1:].lower() == preset["format"] else "." + preset["format"])
+
+
+def prepared(image, preset):
+    scale = preset.get("scale", 1)
+    if scale != 1:
+        image = image.scaled(max(1, round(image.width() * scale)), max(1, round(image.height() * scale)),
+                             Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+    alpha = preset.get("alpha", True) and preset["format"] == "png" and preset.get("depth") != 8
+    if not alpha and image.hasAlphaChannel():
+        flat = QImage(image.size(), QImage.Format_RGB32)
+        flat.fill(Qt.white)
+        painter = QPainter(flat)
+        painter.drawImage(0, 0, image)
+        painter.end()
+        image = flat
+    return image.convertToFormat(FORMATS[(preset.get("depth", 32 if alpha else 24), alpha)], Qt.AvoidDither)
+
+
+def encode(source, width, height, preset, path):
+    # Runs in a worker: reads the canvas from the raw ARGB32 file, converts it and writes path.
+    with open(source, "rb") as f:
+        image = QImage(f.read(), width, height, width * 4, QImage.Format_ARGB32).copy()
+    start = time.perf_counter()
+    image = prepared(image, preset)
+    file = QSaveFile(path)
+    if not file.open(QIODevice.WriteOnly):
+        raise OSError("%s: %s" % (path, file.errorString()))
+    writer = QImageWriter(file, preset["format"].encode())
+    if "quality" in preset:
+        writer.setQuality(preset["quality"])
+    elif "compression" in preset:
+        # Qt's PNG writer takes the zlib level as a quality: level = (100 - quality) * 9 // 91.
+        writer.setQuality(100 - -(-91 * preset["compression"] // 9))
+    if not writer.write(image):
+        file.cancelWriting()
+        raise OSError("%s: %s" % (path, writer.errorString()))
+    if not file.commit():
+        raise OSError("%s: %s" % (path, file.errorString()))
+    return path, time.perf_counter() - start, os.path.getsize(path)
+
+
+def export(image, path, names):
+    # Writes image once per preset, all presets at the same time; returns (name, path, seconds, bytes) each.
+    image = image.convertToFormat(QImage.Format_ARGB32)
+    with tempfile.NamedTemporaryFile(prefix="desk-export-", delete=False) as f:
+        f.write(image.constBits().asstring(image.sizeInBytes()))
+    try:
+        jobs = [(name, pool().submit(encode, f.name, image.width(), image.height(), PRESETS[name],
+                                     output_path(path, name, PRESETS[name], len(names) > 1))) for name in names]
+        return [(name,) + job.result() for name, job in jobs]
+    finally:
+        os.remove(f.name)
+
+
+def report(results):
+    return "\n".join("%s: %s, %.1f ms, %.1f KB" % (name, os.path.basename(path), seconds * 1000, size / 1024)
+                     for name, path, seconds, size in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export an image with Desk's export presets.")
+    parser.add_argument("image")
+    parser.add_argument("output", help="output path; with several presets each gets the preset name appended")
+    parser.add_argument("-p", "--presets", nargs="+", default=list(PRESETS), choices=list(PRESETS))
+    args = parser.parse_args()
+    image = QImage(args.image)
+    if image.isNull():
+        print("%s: cannot read" % args.image, file=sys.stderr)
+        return 1
+    start = time.perf_counter()
+    print(report(export(image, args.output, args.presets)))
+    print("%d presets, %.2f s" % (len(args.presets), time.perf_counter() - start))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
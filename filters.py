@@ -0,0 +1,82 @@
+import numpy as np
+
+import pixels
+from pixels import RED, GREEN, BLUE, ALPHA
+
+COLOURS = [RED, GREEN, BLUE]
+
+
+def luma(rgba):
+    return (rgba[:, :, RED].astype(np.uint32) * 77 + rgba[:, :, GREEN].astype(np.uint32) * 150 +
+            rgba[:, :, BLUE].astype(np.uint32) * 29) >> 8
+
+
+def invert(rgba):
+    rgba[:, :, COLOURS] = 255 - rgba[:, :, COLOURS]
+
+
+def greyscale(rgba):
+    grey = luma(rgba).astype(np.uint8)
+    for channel in COLOURS:
+        rgba[:, :, channel] = grey
+
+
+def threshold(rgba, level=128):
+    value = np.where(luma(rgba) >= level, 255, 0).astype(np.uint8)
+    for channel in COLOURS:
+        rgba[:, :, channel] = value
+
+
+def levels(rgba, black=None, white=None, gamma=1.0):
+    # Without black/white points the 1st and 99th percentiles of the luma are used (auto levels), each
+    # pixel counted by its alpha so transparent parts of the drawing don't pull them down.
+    if black is None or white is None:
+        cumulative = np.cumsum(np.bincount(luma(rgba).ravel(), rgba[:, :, ALPHA].ravel(), minlength=256))
+        low, high = np.searchsorted(cumulative, [cumulative[-1] * 0.01, cumulative[-1] * 0.99])
+        black = int(low) if black is None else black
+        white = int(high) if white is None else white
+    white = max(white, black + 1)
+    table = np.clip((np.arange(256) - black) / (white - black), 0, 1) ** (1 / gamma) * 255
+    table = np.round(table).astype(np.uint8)
+    for channel in COLOURS:
+        rgba[:, :, channel] = table[rgba[:, :, channel]]
+
+
+def box(values, radius, axis):
+    # Running-sum box filter along one axis with the edge pixels repeated.
+    padded = np.concatenate([np.repeat(values.take([0], axis), radius + 1, axis), values,
+                             np.repeat(values.take([-1], axis), radius, axis)], axis)
+    sums = np.cumsum(padded, axis, dtype=np.int64)
+    size = values.shape[axis]
+    return (sums.take(np.arange(2 * radius + 1, 2 * radius + 1 + size), axis) -
+            sums.take(np.arange(size), axis)) // (2 * radius + 1)
+
+
+def blur(rgba, radius=3):
+    values = rgba.astype(np.int64)
+    values[:, :, COLOURS] *= values[:, :, [ALPHA]]
+    values = box(box(values, radius, 0), radius, 1)
+    alpha = values[:, :, [ALPHA]]
+    colours = values[:, :, COLOURS] // np.maximum(alpha, 1)
+    rgba[:, :, COLOURS] = np.clip(colours, 0, 255)
+    rgba[:, :, ALPHA] = alpha[:, :, 0]
+
+
+FILTERS = {"invert": invert, "greyscale": greyscale, "threshold": threshold, "levels": levels, "blur": blur}
+
+
+def margin(steps):
+    # Pixels around a region the steps read from; the blur needs its neighbours, the others none.
+    return sum(params.get("radius", 3) for name, params in steps if name == "blur")
+
+
+def run(image, steps, cancelled=None):
+    # Runs [(name, params), ...] over a copy of an ARGB32 QImage and returns the result as uint32 pixels;
+    # None once cancelled() says so, which is asked before every step.
+    values = pixels.view(image).copy()
+    rgba = pixels.channels(values)
+    for name, params in steps:
+        if cancelled and cancelled():
+            return None
+        FILTERS[name](rgba, **params)
+    return values
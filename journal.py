@@ -0,0 +1,337 @@
+import os
+import json
+import glob
+import zlib
+import struct
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QRect, QSize
+from PyQt5.QtGui import QImage, QColor, QBrush, QTransform
+
+from canvas import SourceImage
+from brushes import Brush, TEXTURES
+from shapes import Shape, ShapeLayer
+from tiles import TiledImage, tile_rect, store_tile
+
+TOOLS = ["brush", "eraser", "line", "rectangle", "circle"]
+MODES = ["", "checkered", "lined"]
+STROKE, BACKGROUND, RESCALE, CLEAR, NEW, OPEN, PATCH, FILL, FILTER, SHAPE, SHAPES, BRUSH_STROKE, LAYER = range(1, 14)
+HEADER = struct.Struct("<BI")
+TEXTURE = struct.Struct("<6dIII")
+TILE = struct.Struct("<iiI")
+CHECKPOINT_BYTES = 8 * 1024 * 1024
+RECOVERY = "recovery"
+
+
+def image_bytes(image):
+    image = image.convertToFormat(QImage.Format_ARGB32)
+    return zlib.compress(image.constBits().asstring(image.sizeInBytes()), 1)
+
+
+def bytes_image(data, width, height):
+    pixels = zlib.decompress(data)
+    return QImage(pixels, width, height, width * 4, QImage.Format_ARGB32).copy()
+
+
+def layer_bytes(layer):
+    # A layer as its size, its base (a colour, or a texture brush with its transform) and the tiles it has
+    # allocated, so a blank canvas costs a few bytes however large it is. Tiles already compressed are
+    # written as they are.
+    parts = [struct.pack("<II", layer.width(), layer.height())]
+    if isinstance(layer.base, QBrush):
+        texture, transform = layer.base.textureImage(), layer.base.transform()
+        data = image_bytes(texture)
+        parts.append(b"\1" + TEXTURE.pack(transform.m11(), transform.m12(), transform.m21(), transform.m22(),
+                                          transform.dx(), transform.dy(), texture.width(), texture.height(),
+                                          len(data)) + data)
+    else:
+        parts.append(struct.pack("<BI", 0, layer.base.rgba()))
+    keys = layer.allocated()
+    parts.append(struct.pack("<I", len(keys)))
+    for key in keys:
+        tile = layer.stored.get(key)
+        if not isinstance(tile, bytes):
+            tile = store_tile(layer.peek(key))
+        parts.append(TILE.pack(key[0], key[1], len(tile)) + tile)
+    return b"".join(parts)
+
+
+def bytes_layer(data):
+    width, height, kind = struct.unpack_from("<IIB", data)
+    offset = struct.calcsize("<IIB")
+    if kind:
+        m11, m12, m21, m22, dx, dy, texture_width, texture_height, length = TEXTURE.unpack_from(data, offset)
+        offset += TEXTURE.size
+        base = QBrush(bytes_image(data[offset:offset + length], texture_width, texture_height))
+        base.setTransform(QTransform(m11, m12, m21, m22, dx, dy))
+        offset += length
+    else:
+        base = QColor.fromRgba(struct.unpack_from("<I", data, offset)[0])
+        offset += 4
+    layer = TiledImage(width, height, base)
+    count, = struct.unpack_from("<I", data, offset)
+    offset += 4
+    for _ in range(count):
+        x, y, length = TILE.unpack_from(data, offset)
+        offset += TILE.size
+        # Kept compressed until something reads the tile.
+        layer.stored[(x, y)] = data[offset:offset + length]
+        offset += length
+    return layer
+
+
+def journal_directories(root=RECOVERY):
+    # One directory per open document, numbered in the order the documents were opened.
+    names = [name for name in glob.glob(os.path.join(root, "*")) if os.path.basename(name).isdigit()]
+    return sorted(names, key=lambda name: int(os.path.basename(name)))
+
+
+class Journal:
+    # Append-only log of canvas operations; checkpoint-N.* plus journal-N.bin, journal-N+1.bin, ...
+    # replayed in order restore the session after a crash. The GUI thread only packs records and takes
+    # snapshots; the writer thread compresses them and does everything with the files, in order.
+    def __init__(self, directory=RECOVERY):
+        self.directory = directory
+        self.file, self.sequence, self.written, self.rotating = None, 0, 0, False
+        self.writer = ThreadPoolExecutor(max_workers=1)
+
+    def path(self, name, sequence):
+        return os.path.join(self.directory, "%s-%d.bin" % (name, sequence))
+
+    def checkpoints(self):
+        found = []
+        for name in glob.glob(os.path.join(self.directory, "checkpoint-*.json")):
+            found.append(int(os.path.basename(name)[len("checkpoint-"):-len(".json")]))
+        return sorted(found)
+
+    def has_recovery(self):
+        return bool(self.checkpoints()) and any(os.path.getsize(name) for name in
+                                                glob.glob(os.path.join(self.directory, "journal-*.bin")))
+
+    def start(self, canvas):
+        os.makedirs(self.directory, exist_ok=True)
+        self.writer.submit(self.discard)
+        canvas.journal = self
+        self.checkpoint(canvas)
+
+    def discard(self):
+        for name in glob.glob(os.path.join(self.directory, "*-*.*")):
+            os.remove(name)
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.discard()
+        if os.path.isdir(self.directory) and not os.listdir(self.directory):
+            os.rmdir(self.directory)
+
+    def append(self, kind, payload):
+        self.writer.submit(self.write, kind, payload)
+
+    def write(self, kind, payload):
+        self.file.write(HEADER.pack(kind, len(payload)) + payload)
+        self.file.flush()
+        self.written += HEADER.size + len(payload)
+
+    def checkpoint(self, canvas):
+        canvas.sync()
+        state = {"background": canvas.now_background.rgba(), "mode": canvas.checkered_or_lined,
+                 "shapes": canvas.shapes.to_json()}
+        self.rotating = True
+        self.writer.submit(self.write_checkpoint, canvas.image.snapshot(), canvas.background.snapshot(), state)
+
+    def write_checkpoint(self, image, background, state):
+        if self.file:
+            self.file.close()
+            self.sequence += 1
+        self.file, self.written = open(self.path("journal", self.sequence), "ab"), 0
+        with open(self.path("checkpoint", self.sequence), "wb") as f:
+            for target, layer in enumerate([image, background]):
+                payload = bytes([target]) + layer_bytes(layer)
+                f.write(HEADER.pack(LAYER, len(payload)) + payload)
+        with open(os.path.join(self.directory, "checkpoint-%d.json" % self.sequence), "w") as f:
+            json.dump(state, f)
+        for name in glob.glob(os.path.join(self.directory, "*-*.*")):
+            if int(os.path.basename(name).split("-")[1].split(".")[0]) < self.sequence:
+                os.remove(name)
+        self.rotating = False
+
+    def write_layers(self, image, background, shapes):
+        for target, layer in enumerate([image, background]):
+            self.write(LAYER, bytes([target]) + layer_bytes(layer))
+        self.write(SHAPES, json.dumps(shapes).encode())
+
+    def write_patches(self, target, tiles):
+        for rect, tile in tiles:
+            data = image_bytes(tile.copy(0, 0, rect.width(), rect.height()))
+            self.write(PATCH, struct.pack("<iiIIB", rect.x(), rect.y(), rect.width(), rect.height(), target) + data)
+
+    def maybe_checkpoint(self, canvas):
+        if self.written > CHECKPOINT_BYTES and not self.rotating:
+            self.checkpoint(canvas)
+
+    def stroke(self, canvas, points):
+        # points are (x, y, pressure); the plain hard brush only needs the positions.
+        brush = canvas.brush
+        if brush.stamped() or canvas.opacity < 1:
+            payload = struct.pack("<BIHdddBBI", TOOLS.index(canvas.instrument), canvas.brush_color.rgba(), canvas.size,
+                                  brush.hardness, brush.spacing, canvas.opacity, brush.pressure,
+                                  TEXTURES.index(brush.texture), len(points))
+            self.append(BRUSH_STROKE, payload + array("d", [v for point in points for v in point]).tobytes())
+        else:
+            fill = canvas.fill_color if canvas.fill_color != "transparent" else None
+            payload = struct.pack("<BIHBII", TOOLS.index(canvas.instrument), canvas.brush_color.rgba(), canvas.size,
+                                  fill is not None, fill.rgba() if fill else 0, len(points))
+            self.append(STROKE, payload + array("i", [v for x, y, _ in points for v in (x, y)]).tobytes())
+        self.maybe_checkpoint(canvas)
+
+    def fill(self, canvas, x, y):
+        self.append(FILL, struct.pack("<IiiB", canvas.brush_color.rgba(), x, y, canvas.tolerance))
+        self.maybe_checkpoint(canvas)
+
+    def filter(self, canvas, steps, rect):
+        payload = struct.pack("<iiII", rect.x(), rect.y(), rect.width(), rect.height())
+        self.append(FILTER, payload + json.dumps(steps).encode())
+        self.maybe_checkpoint(canvas)
+
+    def shape(self, canvas, z, shape):
+        self.append(SHAPE, json.dumps({"z": z, "shape": None if shape is None else shape.to_json()}).encode())
+        self.maybe_checkpoint(canvas)
+
+    def background(self, color, mode):
+        self.append(BACKGROUND, struct.pack("<IB", QColor(color).rgba(), MODES.index(mode)))
+
+    def rescale(self, width, height, aspect, smooth=True):
+        self.append(RESCALE, struct.pack("<IIBB", width, height, aspect, smooth))
+
+    def clear(self):
+        self.append(CLEAR, b"")
+
+    def new(self, width, height):
+        self.append(NEW, struct.pack("<II", width, height))
+
+    def open(self, path, size):
+        self.append(OPEN, struct.pack("<II", size.width(), size.height()) + path.encode())
+
+    def undo_redo(self, canvas, keys, background_keys=()):
+        # keys None means whole layers changed: they go as snapshots, which share their tiles with the canvas.
+        if keys is None:
+            self.writer.submit(self.write_layers, canvas.image.snapshot(), canvas.background.snapshot(),
+                               canvas.shapes.to_json())
+        else:
+            for target, layer, layer_keys in [(0, canvas.image, keys), (1, canvas.background, background_keys)]:
+                if layer_keys:
+                    self.writer.submit(self.write_patches, target, [(tile_rect(key).intersected(layer.rect()),
+                                                                     QImage(layer.tile(key))) for key in layer_keys])
+        self.maybe_checkpoint(canvas)
+
+    def records(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            kind, length = HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            if offset + length > len(data):
+                break
+            yield kind, data[offset:offset + length]
+            offset += length
+
+    def recover(self, canvas):
+        sequence = self.checkpoints()[-1]
+        with open(os.path.join(self.directory, "checkpoint-%d.json" % sequence)) as f:
+            state = json.load(f)
+        for kind, payload in self.records(self.path("checkpoint", sequence)):
+            self.replay(canvas, kind, payload)
+        canvas.now_background = QColor.fromRgba(state["background"])
+        canvas.checkered_or_lined = state["mode"]
+        canvas.shapes = ShapeLayer.from_json(canvas.image.width(), canvas.image.height(), state.get("shapes", []))
+        canvas.update()
+        journal, canvas.journal = canvas.journal, None
+        tools = (canvas.instrument, canvas.brush_color, canvas.size, canvas.fill_color, canvas.tolerance,
+                 canvas.brush, canvas.opacity)
+        journals = sorted(glob.glob(os.path.join(self.directory, "journal-*.bin")),
+                          key=lambda name: int(os.path.basename(name)[len("journal-"):-len(".bin")]))
+        for name in journals:
+            if int(os.path.basename(name)[len("journal-"):-len(".bin")]) >= sequence:
+                for kind, payload in self.records(name):
+                    self.replay(canvas, kind, payload)
+        (canvas.instrument, canvas.brush_color, canvas.size, canvas.fill_color, canvas.tolerance,
+         canvas.brush, canvas.opacity) = tools
+        canvas.journal = journal
+        canvas.sync()
+        canvas.clear_history()
+        canvas.update()
+
+    def replay(self, canvas, kind, payload):
+        if kind == STROKE:
+            tool, color, size, has_fill, fill, count = struct.unpack_from("<BIHBII", payload)
+            values = array("i")
+            values.frombytes(payload[struct.calcsize("<BIHBII"):])
+            points = list(zip(values[0::2], values[1::2]))
+            canvas.instrument, canvas.brush_color, canvas.size = TOOLS[tool], QColor.fromRgba(color), size
+            canvas.fill_color = QColor.fromRgba(fill) if has_fill else "transparent"
+            canvas.brush, canvas.opacity = Brush(), 1.0
+            canvas.press(*points[0])
+            for point in points[1:]:
+                canvas.move(*point)
+            canvas.release()
+        elif kind == BRUSH_STROKE:
+            tool, color, size, hardness, spacing, opacity, pressure, texture, count = \
+                struct.unpack_from("<BIHdddBBI", payload)
+            values = array("d")
+            values.frombytes(payload[struct.calcsize("<BIHdddBBI"):])
+            points = [(int(x), int(y), p) for x, y, p in zip(values[0::3], values[1::3], values[2::3])]
+            canvas.instrument, canvas.brush_color, canvas.size = TOOLS[tool], QColor.fromRgba(color), size
+            canvas.brush, canvas.opacity = Brush(hardness, spacing, bool(pressure), TEXTURES[texture]), opacity
+            canvas.press(*points[0])
+            for point in points[1:]:
+                canvas.move(*point)
+            canvas.release()
+        elif kind == FILL:
+            color, x, y, canvas.tolerance = struct.unpack("<IiiB", payload)
+            canvas.brush_color = QColor.fromRgba(color)
+            canvas.bucket_fill(x, y)
+        elif kind == FILTER:
+            x, y, width, height = struct.unpack_from("<iiII", payload)
+            steps = json.loads(payload[struct.calcsize("<iiII"):].decode())
+            canvas.apply_filter([(name, params) for name, params in steps], QRect(x, y, width, height))
+        elif kind == SHAPE:
+            record = json.loads(payload.decode())
+            canvas.replace_shape(record["z"], None if record["shape"] is None else Shape.from_json(record["shape"]))
+        elif kind == SHAPES:
+            canvas.sync()
+            canvas.shapes = ShapeLayer.from_json(canvas.image.width(), canvas.image.height(),
+                                                 json.loads(payload.decode()))
+            canvas.update()
+        elif kind == BACKGROUND:
+            color, mode = struct.unpack("<IB", payload)
+            canvas.set_background(QColor.fromRgba(color), MODES[mode])
+        elif kind == RESCALE:
+            width, height, aspect, smooth = struct.unpack("<IIBB", payload)
+            canvas.rescale(width, height, bool(aspect), bool(smooth))
+        elif kind == CLEAR:
+            canvas.clear()
+        elif kind == NEW:
+            canvas.new(*struct.unpack("<II", payload))
+        elif kind == OPEN:
+            width, height = struct.unpack_from("<II", payload)
+            try:
+                source = SourceImage(payload[8:].decode())
+                canvas.load(source, source.read(size=QSize(width, height)))
+            except OSError:
+                pass
+        elif kind == PATCH:
+            x, y, width, height, target = struct.unpack_from("<iiIIB", payload)
+            image = bytes_image(payload[struct.calcsize("<iiIIB"):], width, height)
+            canvas.restore_rect(QRect(x, y, width, height), image, target == 1)
+        elif kind == LAYER:
+            canvas.sync()
+            if payload[0]:
+                canvas.background = bytes_layer(payload[1:])
+            else:
+                canvas.image = bytes_layer(payload[1:])
+            canvas.update()
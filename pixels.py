@@ -0,0 +1,195 @@
+import sys
+
+import numpy as np
+
+from PyQt5.QtGui import QImage
+
+from tiles import TILE_SIZE, tile_rect, tile_keys
+
+# Tiles flood() reads at a time, which bounds its memory on huge canvases.
+FILL_CHUNK = 1024
+
+# Byte index of each channel in channels(): ARGB32 stores 0xAARRGGBB as a native-endian uint32.
+if sys.byteorder == "little":
+    BLUE, GREEN, RED, ALPHA = range(4)
+else:
+    ALPHA, RED, GREEN, BLUE = range(4)
+
+
+def view(image, const=False):
+    # uint32 rows of an ARGB32 image (0xAARRGGBB per pixel), sharing its memory; bits() detaches a shared
+    # image first, so writing through the view never leaks into snapshots. A const view is read-only and
+    # detaches nothing. Keep the image alive while the view is in use.
+    if image.format() != QImage.Format_ARGB32:
+        raise ValueError("expected an ARGB32 image, got format %d" % image.format())
+    data = image.constBits() if const else image.bits()
+    data.setsize(image.sizeInBytes())
+    rows = np.frombuffer(data, np.uint32).reshape(image.height(), image.bytesPerLine() // 4)
+    return rows[:, :image.width()]
+
+
+def channels(pixels):
+    # The same pixels as (height, width, 4) bytes in memory order; index them with RED, GREEN, BLUE, ALPHA.
+    return pixels.view(np.uint8).reshape(pixels.shape[0], pixels.shape[1], 4)
+
+
+def write(store, rect, values, touch=None):
+    # Copies a (height, width) uint32 array onto rect of a TiledImage through views of its own tiles;
+    # touch is called with each tile's part first (the undo command's touch). Tiles the values would leave
+    # as they are are skipped, so they stay shared or unallocated.
+    for key in tile_keys(rect, store.rect()):
+        part = tile_rect(key).intersected(rect)
+        x, y = part.x() - key[0] * TILE_SIZE, part.y() - key[1] * TILE_SIZE
+        new = values[part.y() - rect.y():part.bottom() + 1 - rect.y(), part.x() - rect.x():part.right() + 1 - rect.x()]
+        tile = store.tile(key)
+        if (view(tile, True)[y:y + part.height(), x:x + part.width()] == new).all():
+            continue
+        if touch is not None:
+            touch(part)
+        view(store.writable(key))[y:y + part.height(), x:x + part.width()] = new
+
+
+def clear_transparent(pixels):
+    # Fully transparent pixels as 0, whatever colour they were left with.
+    pixels[pixels >> 24 == 0] = 0
+
+
+def similar(pixels, color, tolerance):
+    if tolerance <= 0:
+        return pixels == np.uint32(color)
+    seed = np.array([color], np.uint32).view(np.uint8)
+    bytes = channels(pixels)
+    match = np.ones(pixels.shape, bool)
+    for i in range(4):
+        channel = bytes[:, :, i]
+        if seed[i] > tolerance:
+            match &= channel >= seed[i] - tolerance
+        if seed[i] < 255 - tolerance:
+            match &= channel <= seed[i] + tolerance
+    return match
+
+
+def connected(keyed_starts, keyed_ends, stride, seed):
+    # Scanline fill on runs: keyed_starts/keyed_ends are the runs of matching pixels as row * stride +
+    # column (ends exclusive), sorted. The runs connected to the one holding seed are collected by walking
+    # overlaps between neighbouring rows, found for all runs at once; the walk itself is plain list work.
+    below = (np.searchsorted(keyed_ends, keyed_starts + stride, side="right").tolist(),
+             np.searchsorted(keyed_starts, keyed_ends + stride, side="left").tolist())
+    above = (np.searchsorted(keyed_ends, keyed_starts - stride, side="right").tolist(),
+             np.searchsorted(keyed_starts, keyed_ends - stride, side="left").tolist())
+
+    first = int(np.searchsorted(keyed_ends, seed, side="right"))
+    filled = bytearray(len(keyed_starts))
+    filled[first] = 1
+    queue = [first]
+    while queue:
+        run = queue.pop()
+        for low, high in (below, above):
+            for neighbour in range(low[run], high[run]):
+                if not filled[neighbour]:
+                    filled[neighbour] = 1
+                    queue.append(neighbour)
+    return np.frombuffer(filled, bool)
+
+
+def tile_matches(keys, tile, color, tolerance, width, height):
+    # Which pixels of the tiles at keys match color, as (len(keys), TILE_SIZE, TILE_SIZE); the parts of
+    # tiles past the canvas edge never do.
+    values = np.empty((len(keys) * TILE_SIZE, TILE_SIZE), np.uint32)
+    for i, key in enumerate(keys):
+        values[i * TILE_SIZE:(i + 1) * TILE_SIZE] = view(tile(key), True)
+    matches = similar(values, color, tolerance).reshape(len(keys), TILE_SIZE, TILE_SIZE)
+    matches[np.array([x for x, _ in keys]) == width // TILE_SIZE, :, width % TILE_SIZE:] = False
+    matches[np.array([y for _, y in keys]) == height // TILE_SIZE, height % TILE_SIZE:, :] = False
+    return matches
+
+
+def flood(width, height, base, colors, tile, x, y, tolerance=0):
+    # Bucket fill from (x, y) over a canvas in TILE_SIZE tiles. Tiles known to be one colour are matched
+    # as a whole: base is the colour of every tile not in colors, which maps the other keys to theirs, or
+    # to None where tile(key) has to be read. The runs of every row start and end at tile borders or
+    # inside the tiles read, so the whole canvas is filled at once and its plain parts cost next to
+    # nothing. Yields (key, mask) for every tile with filled pixels; mask is None where all of it is.
+    rows, columns = -(-height // TILE_SIZE), -(-width // TILE_SIZE)
+    keys = [key for key, value in colors.items() if value is None]
+    grid = np.full((rows, columns), 0 if base is None else base, np.uint32)
+    read = np.zeros((rows, columns), bool)
+    for (column, row), value in colors.items():
+        if value is None:
+            read[row, column] = True
+        else:
+            grid[row, column] = value
+    if read[y // TILE_SIZE, x // TILE_SIZE]:
+        color = int(view(tile((x // TILE_SIZE, y // TILE_SIZE)), True)[y % TILE_SIZE, x % TILE_SIZE])
+    else:
+        color = int(grid[y // TILE_SIZE, x // TILE_SIZE])
+
+    # Whether the first and the last pixel of each tile row match; the tiles read fill theirs in below.
+    first = np.repeat(similar(grid, color, tolerance)[:, :, None], TILE_SIZE, 2)
+    first[-1, :, height - (rows - 1) * TILE_SIZE:] = False
+    last = first.copy()
+    starts, ends = [], []
+    key_columns = np.array([column for column, _ in keys], np.int64)
+    key_rows = np.array([row for _, row in keys], np.int64)
+    for chunk in range(0, len(keys), FILL_CHUNK):
+        matches = tile_matches(keys[chunk:chunk + FILL_CHUNK], tile, color, tolerance, width, height)
+        chunk_columns, chunk_rows = key_columns[chunk:chunk + FILL_CHUNK], key_rows[chunk:chunk + FILL_CHUNK]
+        first[chunk_rows, chunk_columns], last[chunk_rows, chunk_columns] = matches[:, :, 0], matches[:, :, -1]
+        # 1 where a run starts at column + 1, -1 where one ends there.
+        edges = np.diff(matches.view(np.int8), axis=2)
+        at = np.flatnonzero(edges)
+        i, row, column = np.unravel_index(at, edges.shape)
+        found = (chunk_rows[i] * TILE_SIZE + row, chunk_columns[i] * TILE_SIZE + column + 1)
+        starting = edges.ravel()[at] > 0
+        starts.append((found[0][starting], found[1][starting]))
+        ends.append((found[0][~starting], found[1][~starting]))
+    # The same across tile borders and the canvas edges.
+    edges = np.zeros((rows, columns + 1, TILE_SIZE), np.int8)
+    edges[:, :-1] += first
+    edges[:, 1:] -= last
+    at = np.flatnonzero(edges)
+    tile_row, border, row = np.unravel_index(at, edges.shape)
+    found = (tile_row * TILE_SIZE + row, np.minimum(border * TILE_SIZE, width))
+    starting = edges.ravel()[at] > 0
+    starts.append((found[0][starting], found[1][starting]))
+    ends.append((found[0][~starting], found[1][~starting]))
+    stride = width + 2
+    keyed_starts = np.sort(np.concatenate([row * stride + column for row, column in starts]))
+    keyed_ends = np.sort(np.concatenate([row * stride + column for row, column in ends]))
+
+    filled = connected(keyed_starts, keyed_ends, stride, y * stride + x)
+    run_rows = keyed_starts[filled] // stride
+    run_starts, run_ends = keyed_starts[filled] - run_rows * stride, keyed_ends[filled] - run_rows * stride
+    bands, lows, highs = run_rows // TILE_SIZE, run_starts // TILE_SIZE, (run_ends - 1) // TILE_SIZE
+
+    # A plain tile any filled run reaches is filled throughout: its rows all match and overlap.
+    spans = np.zeros((rows, columns + 1), np.int32)
+    np.add.at(spans, (bands, lows), 1)
+    np.add.at(spans, (bands, highs + 1), -1)
+    for row, column in zip(*np.nonzero((np.cumsum(spans, axis=1)[:, :-1] > 0) & ~read)):
+        yield (int(column), int(row)), None
+
+    # The runs over each tile read, pieced together into its mask.
+    codes = key_rows * (columns + 1) + key_columns
+    order = np.argsort(codes)
+    low = np.searchsorted(codes[order], bands * (columns + 1) + lows, side="left")
+    counts = np.searchsorted(codes[order], bands * (columns + 1) + highs, side="right") - low
+    runs = np.repeat(np.arange(len(counts)), counts)
+    hits = order[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - low, counts)]
+    by_tile = np.argsort(hits, kind="stable")
+    runs, hits = runs[by_tile], hits[by_tile]
+    hit = np.unique(hits)
+    for chunk in range(0, len(hit), FILL_CHUNK):
+        tiles = hit[chunk:chunk + FILL_CHUNK]
+        low, high = np.searchsorted(hits, tiles[0], side="left"), np.searchsorted(hits, tiles[-1], side="right")
+        index, tile_runs = np.searchsorted(tiles, hits[low:high]), runs[low:high]
+        left = key_columns[hits[low:high]] * TILE_SIZE
+        row = run_rows[tile_runs] - key_rows[hits[low:high]] * TILE_SIZE
+        steps = np.zeros((len(tiles), TILE_SIZE, TILE_SIZE + 1), np.int8)
+        np.add.at(steps, (index, row, np.maximum(run_starts[tile_runs] - left, 0)), 1)
+        np.add.at(steps, (index, row, np.minimum(run_ends[tile_runs] - left, TILE_SIZE)), -1)
+        masks = np.cumsum(steps, axis=2, dtype=np.int8)[:, :, :-1] > 0
+        for i, count in enumerate(masks.sum(axis=(1, 2)).tolist()):
+            column, row = keys[tiles[i]]
+            inside = min(TILE_SIZE, width - column * TILE_SIZE) * min(TILE_SIZE, height - row * TILE_SIZE)
+            yield (column, row), None if count == inside else masks[i]
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import threading
+
+EVENT_LIMIT = 200000
+
+
+class Profiler:
+    # Hot-path timings kept as Chrome trace events. While enabled the listed methods are replaced by
+    # timing wrappers (on the instance, class or module they were looked up on); disabling puts the
+    # originals back, so when it is off nothing is measured and nothing is in the way.
+    def __init__(self, limit=EVENT_LIMIT):
+        self.enabled, self.limit = False, limit
+        self.events, self.patched, self.latest = [], [], {}
+        self.input_time, self.trace_path, self.traced = None, None, 0
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, name, start, end, category="desk"):
+        event = {"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                 "ts": round((start - self.origin) * 1e6, 1), "dur": round((end - start) * 1e6, 1)}
+        with self.lock:
+            self.events.append(event)
+            self.latest[name] = (end - start) * 1000
+            if len(self.events) > self.limit:
+                dropped = len(self.events) - self.limit
+                del self.events[:dropped]
+                self.traced = max(0, self.traced - dropped)
+
+    def wrap(self, name, function, input=False, frame=False, stroke=False):
+        # input: starts the event-to-paint latency; frame: ends it; stroke: appends the trace file.
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            if input and self.input_time is None:
+                self.input_time = start
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                self.add(name, start, end)
+                if frame and self.input_time is not None:
+                    self.add("latency", self.input_time, end, "latency")
+                    self.input_time = None
+                if stroke and self.trace_path:
+                    self.write_trace()
+        return timed
+
+    def enable(self, paths, trace_path=None):
+        # paths: (owner, attribute, name, options) with options passed on to wrap.
+        if self.enabled:
+            self.disable()
+        for owner, attribute, name, options in paths:
+            self.patched.append((owner, attribute, owner.__dict__.get(attribute)))
+            setattr(owner, attribute, self.wrap(name, getattr(owner, attribute), **options))
+        self.enabled, self.trace_path, self.input_time = True, trace_path, None
+        self.traced = len(self.events)
+
+    def disable(self):
+        if self.trace_path:
+            self.write_trace()
+        for owner, attribute, original in reversed(self.patched):
+            if original is None:
+                delattr(owner, attribute)
+            else:
+                setattr(owner, attribute, original)
+        self.patched, self.enabled, self.trace_path = [], False, None
+
+    def write_trace(self):
+        # Chrome's JSON array format may stay open, so every stroke is appended as it ends.
+        with self.lock:
+            events, self.traced = self.events[self.traced:], len(self.events)
+        if events:
+            with open(self.trace_path, "a") as f:
+                if not f.tell():
+                    f.write("[\n")
+                f.write("".join(json.dumps(event) + ",\n" for event in events))
+
+    def dump(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
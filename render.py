@@ -0,0 +1,87 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage, QPainter
+
+from tiles import tile_rect
+
+
+class Renderer:
+    # Rasterises strokes and shapes on one worker thread, into its own copies of the layers' tiles. The GUI
+    # thread hands over a tile the first time a stroke reaches it and takes copies of the painted tiles back,
+    # by (layer, key), with take() after ready() fires; it never paints and the worker never reads a layer.
+    # Without an event loop (batch rendering) everything runs inline.
+    def __init__(self, ready, threaded=True):
+        self.ready = ready
+        self.executor = ThreadPoolExecutor(max_workers=1) if threaded else None
+        self.pending, self.lock, self.finished = None, threading.Lock(), {}
+        self.tiles, self.painters, self.pen, self.clear = {}, {}, None, False
+        self.masks, self.opacity = {}, None
+
+    def submit(self, function, *args):
+        if self.executor is None:
+            function(*args)
+        else:
+            self.pending = self.executor.submit(function, *args)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def take(self):
+        with self.lock:
+            finished, self.finished = self.finished, {}
+        return finished
+
+    def begin(self, pen, clear, opacity=None):
+        # With an opacity the stroke builds up in masks of its own and every tile is the tile from before the
+        # stroke with the mask laid over it (or cut out of it, to erase) at that opacity, however often the
+        # stroke crosses itself.
+        self.pen, self.clear, self.opacity = pen, clear, opacity
+
+    def painter(self, layer, key):
+        painter = self.painters.get((layer, key))
+        if painter is None:
+            target = self.tiles[(layer, key)]
+            if self.opacity is not None:
+                target = self.masks[(layer, key)] = QImage(target.size(), QImage.Format_ARGB32_Premultiplied)
+                target.fill(Qt.transparent)
+            painter = self.painters[(layer, key)] = QPainter(target)
+            painter.translate(-tile_rect(key).topLeft())
+            if self.clear and self.opacity is None:
+                painter.setCompositionMode(QPainter.CompositionMode_Clear)
+            if self.pen is not None:
+                painter.setPen(self.pen)
+        return painter
+
+    def paint(self, layer, keys, tiles, function):
+        self.tiles.update(((layer, key), tile) for key, tile in tiles.items())
+        for key in keys:
+            function(self.painter(layer, key))
+        with self.lock:
+            for key in keys:
+                self.finished[(layer, key)] = self.result(layer, key)
+        self.ready()
+
+    def result(self, layer, key):
+        tile = self.tiles[(layer, key)].copy()
+        if self.opacity is not None:
+            painter = QPainter(tile)
+            painter.setOpacity(self.opacity)
+            if self.clear:
+                painter.setCompositionMode(QPainter.CompositionMode_DestinationOut)
+            painter.drawImage(0, 0, self.masks[(layer, key)])
+            painter.end()
+        return tile
+
+    def end(self):
+        for painter in self.painters.values():
+            painter.end()
+        self.tiles, self.painters, self.pen, self.clear = {}, {}, None, False
+        self.masks, self.opacity = {}, None
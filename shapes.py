@@ -0,0 +1,311 @@
+import math
+
+from PyQt5.QtCore import Qt, QPoint, QRect
+from PyQt5.QtGui import QPainter, QColor, QPen, QBrush
+
+from tiles import TiledImage, tile_rect, tile_keys, TILE_SIZE
+
+NODE_ENTRIES = 16
+NODE_MINIMUM = 6
+HIT_SLOP = 3
+
+
+def stroke_rect(x1, y1, x2, y2, width):
+    margin = width // 2 + 2
+    return QRect(QPoint(min(x1, x2), min(y1, y2)),
+                 QPoint(max(x1, x2), max(y1, y2))).adjusted(-margin, -margin, margin, margin)
+
+
+def segment_rects(x1, y1, x2, y2, width):
+    # A long diagonal segment is covered by a run of small rects, so only the tiles it crosses get allocated.
+    steps = max(abs(x2 - x1), abs(y2 - y1)) // TILE_SIZE + 1
+    for i in range(steps):
+        yield stroke_rect(x1 + (x2 - x1) * i // steps, y1 + (y2 - y1) * i // steps,
+                          x1 + (x2 - x1) * (i + 1) // steps, y1 + (y2 - y1) * (i + 1) // steps, width)
+
+
+def paint_shape(painter, instrument, color, size, fill, start_pos, end_pos):
+    painter.setPen(QPen(color, size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+    if instrument == "line":
+        painter.drawLine(start_pos[0], start_pos[1], end_pos[0], end_pos[1])
+        return
+    if fill != "transparent":
+        painter.setBrush(QBrush(fill, Qt.SolidPattern))
+    if instrument == "rectangle":
+        painter.drawRect(start_pos[0], start_pos[1], end_pos[0] - start_pos[0], end_pos[1] - start_pos[1])
+    elif instrument == "circle":
+        painter.drawEllipse(start_pos[0], start_pos[1], end_pos[0] - start_pos[0], end_pos[1] - start_pos[1])
+
+
+def paint_region(painter, shapes, rect):
+    # Clears rect and paints the shapes over it, bottom first.
+    painter.save()
+    painter.setClipRect(rect)
+    painter.setCompositionMode(QPainter.CompositionMode_Clear)
+    painter.fillRect(rect, Qt.transparent)
+    painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+    for shape in shapes:
+        painter.save()
+        shape.paint(painter)
+        painter.restore()
+    painter.restore()
+
+
+class Shape:
+    # A line, rectangle or circle kept as geometry and style; edits make a new Shape.
+    def __init__(self, instrument, start, end, color, size, fill="transparent"):
+        self.instrument, self.start, self.end = instrument, tuple(start), tuple(end)
+        self.color, self.size, self.fill = QColor(color), size, fill
+
+    @classmethod
+    def from_json(cls, data):
+        fill = "transparent" if data["fill"] is None else QColor.fromRgba(data["fill"])
+        return cls(data["tool"], data["start"], data["end"], QColor.fromRgba(data["color"]), data["size"], fill)
+
+    def to_json(self):
+        return {"tool": self.instrument, "start": list(self.start), "end": list(self.end), "size": self.size,
+                "color": self.color.rgba(), "fill": None if self.fill == "transparent" else self.fill.rgba()}
+
+    def bounds(self):
+        return stroke_rect(*self.start, *self.end, self.size)
+
+    def rects(self):
+        # The parts of the canvas the shape paints on: runs along a line or the edges of an empty rectangle.
+        if self.instrument == "line":
+            return list(segment_rects(*self.start, *self.end, self.size))
+        if self.instrument == "rectangle" and self.fill == "transparent":
+            (x1, y1), (x2, y2) = self.start, self.end
+            return [stroke_rect(x1, y1, x2, y1, self.size), stroke_rect(x2, y1, x2, y2, self.size),
+                    stroke_rect(x1, y2, x2, y2, self.size), stroke_rect(x1, y1, x1, y2, self.size)]
+        return [self.bounds()]
+
+    def paint(self, painter):
+        paint_shape(painter, self.instrument, self.color, self.size, self.fill, self.start, self.end)
+
+    def moved(self, dx, dy):
+        return Shape(self.instrument, (self.start[0] + dx, self.start[1] + dy), (self.end[0] + dx, self.end[1] + dy),
+                     self.color, self.size, self.fill)
+
+    def restyled(self, color, size, fill):
+        return Shape(self.instrument, self.start, self.end, color, size, fill)
+
+    def scaled(self, sx, sy):
+        return Shape(self.instrument, (round(self.start[0] * sx), round(self.start[1] * sy)),
+                     (round(self.end[0] * sx), round(self.end[1] * sy)), self.color, self.size, self.fill)
+
+    def hit(self, x, y, slop=HIT_SLOP):
+        reach = self.size / 2 + slop
+        (x1, y1), (x2, y2) = self.start, self.end
+        if self.instrument == "line":
+            dx, dy = x2 - x1, y2 - y1
+            t = 0 if dx == dy == 0 else max(0, min(1, ((x - x1) * dx + (y - y1) * dy) / (dx * dx + dy * dy)))
+            return math.hypot(x - x1 - t * dx, y - y1 - t * dy) <= reach
+        left, right, top, bottom = min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2)
+        if self.instrument == "rectangle":
+            outside = max(left - x, x - right, top - y, y - bottom)
+            return outside <= reach if self.fill != "transparent" else abs(outside) <= reach
+        a, b = (right - left) / 2, (bottom - top) / 2
+        if a < 1 or b < 1:
+            return left - reach <= x <= right + reach and top - reach <= y <= bottom + reach
+        d = math.hypot((x - left - a) / a, (y - top - b) / b)
+        return (d - 1) * min(a, b) <= reach if self.fill != "transparent" else abs(d - 1) * min(a, b) <= reach
+
+
+def united(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def area(r):
+    return (r[2] - r[0]) * (r[3] - r[1])
+
+
+def overlaps(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def box(rect):
+    return rect.left(), rect.top(), rect.right(), rect.bottom()
+
+
+class Node:
+    __slots__ = ("leaf", "entries", "box")
+
+    def __init__(self, leaf, entries=()):
+        self.leaf, self.entries = leaf, list(entries)
+        self.box = None
+        self.refresh()
+
+    def refresh(self):
+        boxes = [entry[0] for entry in self.entries]
+        self.box = (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes),
+                    max(b[3] for b in boxes)) if boxes else None
+
+
+class RTree:
+    # Guttman R-tree with quadratic splits over (left, top, right, bottom) boxes; search and insert visit
+    # one path or the overlapping subtrees instead of every item.
+    def __init__(self):
+        self.root, self.count = Node(True), 0
+
+    def __len__(self):
+        return self.count
+
+    def search(self, query):
+        found, nodes = [], [self.root]
+        while nodes:
+            node = nodes.pop()
+            for entry_box, entry in node.entries:
+                if overlaps(entry_box, query):
+                    if node.leaf:
+                        found.append(entry)
+                    else:
+                        nodes.append(entry)
+        return found
+
+    def insert(self, entry_box, item):
+        self.count += 1
+        self.add((entry_box, item))
+
+    def add(self, entry):
+        sibling = self.place(self.root, entry)
+        if sibling is not None:
+            self.root = Node(False, [(self.root.box, self.root), (sibling.box, sibling)])
+
+    def place(self, node, entry):
+        # Goes down the child needing the least enlargement; returns the new sibling if node had to split.
+        if node.leaf:
+            node.entries.append(entry)
+        else:
+            index = min(range(len(node.entries)), key=lambda i: (
+                area(united(node.entries[i][0], entry[0])) - area(node.entries[i][0]), area(node.entries[i][0])))
+            child = node.entries[index][1]
+            sibling = self.place(child, entry)
+            node.entries[index] = (child.box, child)
+            if sibling is not None:
+                node.entries.append((sibling.box, sibling))
+        if len(node.entries) > NODE_ENTRIES:
+            return self.split(node)
+        node.refresh()
+        return None
+
+    def split(self, node):
+        entries = node.entries
+        _, first, second = max((area(united(entries[i][0], entries[j][0])) - area(entries[i][0]) - area(entries[j][0]),
+                                i, j) for i in range(len(entries)) for j in range(i + 1, len(entries)))
+        groups = [[entries[first]], [entries[second]]]
+        boxes = [entries[first][0], entries[second][0]]
+        rest = [entry for i, entry in enumerate(entries) if i not in (first, second)]
+        while rest:
+            for group in (0, 1):
+                if len(groups[group]) + len(rest) <= NODE_MINIMUM:
+                    groups[group].extend(rest)
+                    rest = []
+                    break
+            if not rest:
+                break
+            entry = rest.pop()
+            growth = [area(united(boxes[g], entry[0])) - area(boxes[g]) for g in (0, 1)]
+            group = 0 if (growth[0], len(groups[0])) <= (growth[1], len(groups[1])) else 1
+            groups[group].append(entry)
+            boxes[group] = united(boxes[group], entry[0])
+        node.entries = groups[0]
+        node.refresh()
+        return Node(node.leaf, groups[1])
+
+    def remove(self, entry_box, item):
+        orphans = []
+        if not self.take(self.root, entry_box, item, orphans):
+            return False
+        self.count -= 1
+        while not self.root.leaf and len(self.root.entries) == 1:
+            self.root = self.root.entries[0][1]
+        if not self.root.entries:
+            self.root = Node(True)
+        for node in orphans:
+            for entry in self.items(node):
+                self.add(entry)
+        return True
+
+    def take(self, node, entry_box, item, orphans):
+        # Removes the item below node; children left under the minimum are cut off and end up in orphans.
+        if node.leaf:
+            for i, (found_box, found) in enumerate(node.entries):
+                if found == item:
+                    del node.entries[i]
+                    node.refresh()
+                    return True
+            return False
+        for i, (child_box, child) in enumerate(node.entries):
+            if overlaps(child_box, entry_box) and self.take(child, entry_box, item, orphans):
+                if len(child.entries) < NODE_MINIMUM:
+                    del node.entries[i]
+                    orphans.append(child)
+                else:
+                    node.entries[i] = (child.box, child)
+                node.refresh()
+                return True
+        return False
+
+    def items(self, node):
+        if node.leaf:
+            return list(node.entries)
+        return [entry for _, child in node.entries for entry in self.items(child)]
+
+
+class ShapeLayer:
+    # Shapes by z (their stacking order, which is also their id) in an R-tree, rasterised into a transparent
+    # TiledImage that sits above the drawing in the composite.
+    def __init__(self, width, height):
+        self.raster = TiledImage(width, height, QColor(0, 0, 0, 0))
+        self.shapes, self.tree, self.next_z = {}, RTree(), 0
+
+    @classmethod
+    def from_json(cls, width, height, data):
+        layer = cls(width, height)
+        for z, shape in data:
+            layer.replace(z, Shape.from_json(shape))
+        layer.rasterise()
+        return layer
+
+    def to_json(self):
+        return [[z, shape.to_json()] for z, shape in sorted(self.shapes.items())]
+
+    def replace(self, z, shape):
+        # Puts shape at z (a new z on top when z is None; None as shape deletes) and returns z.
+        if z is None:
+            z = self.next_z
+        old = self.shapes.pop(z, None)
+        if old is not None:
+            self.tree.remove(box(old.bounds()), z)
+        if shape is not None:
+            self.shapes[z] = shape
+            self.tree.insert(box(shape.bounds()), z)
+        self.next_z = max(self.next_z, z + 1)
+        return z
+
+    def query(self, rect):
+        return [self.shapes[z] for z in sorted(self.tree.search(box(rect)))]
+
+    def at(self, x, y, slop=HIT_SLOP):
+        hits = [z for z in self.tree.search((x - slop, y - slop, x + slop, y + slop)) if self.shapes[z].hit(x, y, slop)]
+        return max(hits) if hits else None
+
+    def scaled(self, width, height, sx, sy):
+        layer = ShapeLayer(width, height)
+        for z, shape in self.shapes.items():
+            layer.replace(z, shape.scaled(sx, sy))
+        layer.rasterise()
+        return layer
+
+    def rasterise(self, rect=None):
+        # Repaints the tiles under rect (everything by default) on the calling thread.
+        rect = self.raster.rect() if rect is None else rect
+        for key in tile_keys(rect, self.raster.rect()):
+            shapes = self.query(tile_rect(key))
+            if not shapes:
+                self.raster.set(key, None)
+                continue
+            painter = QPainter(self.raster.writable(key))
+            painter.translate(-tile_rect(key).topLeft())
+            paint_region(painter, shapes, tile_rect(key))
+            painter.end()
@@ -0,0 +1,383 @@
+import mmap
+import zlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QRect, QRectF
+from PyQt5.QtGui import QPainter, QImage, QColor, QBrush, QTransform
+
+TILE_SIZE = 64
+TILE_BYTES = TILE_SIZE * TILE_SIZE * 4
+HOT_TILES = 4096
+SEGMENT_TILES = 1024
+COMPOSITE_TILES = 2048
+
+
+def tile_rect(key):
+    return QRect(key[0] * TILE_SIZE, key[1] * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+
+
+def tile_keys(rect, bounds):
+    rect = rect.intersected(bounds)
+    if rect.isEmpty():
+        return []
+    return [(x, y) for y in range(rect.top() // TILE_SIZE, rect.bottom() // TILE_SIZE + 1)
+            for x in range(rect.left() // TILE_SIZE, rect.right() // TILE_SIZE + 1)]
+
+
+class Slot:
+    # A tile's place in SCRATCH. Layers, snapshots and undo steps share Slot objects; once the last of them
+    # lets go of one, its place is handed out again.
+    __slots__ = ("scratch", "segment", "index")
+
+    def __init__(self, scratch, segment, index):
+        self.scratch, self.segment, self.index = scratch, segment, index
+
+    def __del__(self):
+        self.scratch.free.append((self.segment, self.index))
+
+
+class Scratch:
+    # Spilled tiles go into fixed-size memory-mapped segments of a temporary file. A slot is never written
+    # while anything holds it, so snapshots and worker threads can keep reading it; freed slots are reused
+    # before the file grows.
+    def __init__(self):
+        self.files, self.segments, self.used, self.free = [], [], SEGMENT_TILES, []
+        self.lock = threading.Lock()
+
+    def store(self, tile):
+        try:
+            segment, index = self.free.pop()
+        except IndexError:
+            with self.lock:
+                if self.used == SEGMENT_TILES:
+                    scratch = tempfile.TemporaryFile(prefix="desk-tiles-")
+                    scratch.truncate(SEGMENT_TILES * TILE_BYTES)
+                    self.files.append(scratch)
+                    self.segments.append(mmap.mmap(scratch.fileno(), SEGMENT_TILES * TILE_BYTES))
+                    self.used = 0
+                segment, index = len(self.segments) - 1, self.used
+                self.used += 1
+        offset = index * TILE_BYTES
+        self.segments[segment][offset:offset + TILE_BYTES] = tile.constBits().asstring(TILE_BYTES)
+        return Slot(self, segment, index)
+
+    def load(self, slot):
+        offset = slot.index * TILE_BYTES
+        pixels = self.segments[slot.segment][offset:offset + TILE_BYTES]
+        return QImage(pixels, TILE_SIZE, TILE_SIZE, TILE_SIZE * 4, QImage.Format_ARGB32).copy()
+
+
+SCRATCH = Scratch()
+SOLID_TILES = {}
+SOLID_KEYS = {}
+
+
+def store_tile(tile, spill=False):
+    # A tile out of RAM: zlib-compressed bytes, or with spill a SCRATCH slot; None stays None.
+    if isinstance(tile, bytes) and spill:
+        tile = load_tile(tile)
+    if isinstance(tile, QImage):
+        return SCRATCH.store(tile) if spill else zlib.compress(tile.constBits().asstring(TILE_BYTES), 1)
+    return tile
+
+
+def load_tile(tile):
+    # The other way round; QImage tiles and None come back as they are.
+    if isinstance(tile, bytes):
+        return QImage(zlib.decompress(tile), TILE_SIZE, TILE_SIZE, TILE_SIZE * 4, QImage.Format_ARGB32).copy()
+    if isinstance(tile, Slot):
+        return SCRATCH.load(tile)
+    return tile
+
+
+def solid_tile(color):
+    if color.rgba() not in SOLID_TILES:
+        tile = QImage(TILE_SIZE, TILE_SIZE, QImage.Format_ARGB32)
+        tile.fill(color)
+        SOLID_TILES[color.rgba()] = tile
+        SOLID_KEYS[tile.cacheKey()] = color.rgba()
+    return SOLID_TILES[color.rgba()]
+
+
+class TiledImage:
+    # Sparse canvas storage in TILE_SIZE tiles. A tile that was never painted is not stored: it reads
+    # through to the base, which is a QColor, a texture QBrush or another TiledImage (the background).
+    # Stored tiles share pixels with snapshots until one side paints; cold ones can be spilled to SCRATCH
+    # (solid ones are only set aside), and those of a document nobody is looking at compressed or spilled
+    # (in stored), until they are read.
+    def __init__(self, width, height, base=QColor(255, 255, 255)):
+        self.w, self.h, self.base = width, height, base
+        self.tiles, self.spilled, self.stored = OrderedDict(), {}, {}
+
+    @classmethod
+    def from_image(cls, image, base=QColor(255, 255, 255)):
+        store = cls(image.width(), image.height(), base)
+        image = image.convertToFormat(QImage.Format_ARGB32)
+        for key in tile_keys(image.rect(), image.rect()):
+            tile = image.copy(tile_rect(key))
+            if not isinstance(base, QColor) or tile != store.base_tile(key):
+                store.tiles[key] = tile
+        return store
+
+    def width(self):
+        return self.w
+
+    def height(self):
+        return self.h
+
+    def size(self):
+        return self.rect().size()
+
+    def rect(self):
+        return QRect(0, 0, self.w, self.h)
+
+    def snapshot(self):
+        store = TiledImage(self.w, self.h, self.base)
+        store.tiles = OrderedDict((key, QImage(tile)) for key, tile in self.tiles.items())
+        store.spilled, store.stored = dict(self.spilled), dict(self.stored)
+        return store
+
+    def byte_count(self):
+        return len(self.tiles) * TILE_BYTES + sum(len(tile) for tile in self.stored.values() if isinstance(tile, bytes))
+
+    def allocated(self):
+        return list(self.tiles) + list(self.spilled) + list(self.stored)
+
+    def peek(self, key):
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+        elif key in self.spilled:
+            tile = self.tiles[key] = load_tile(self.spilled.pop(key))
+        elif key in self.stored:
+            tile = self.tiles[key] = load_tile(self.stored.pop(key))
+        return tile
+
+    def shared(self, key):
+        tile = self.peek(key)
+        return None if tile is None else QImage(tile)
+
+    def base_tile(self, key):
+        if isinstance(self.base, TiledImage):
+            return self.base.tile(key)
+        if isinstance(self.base, QColor):
+            return solid_tile(self.base)
+        tile = QImage(TILE_SIZE, TILE_SIZE, QImage.Format_ARGB32)
+        painter = QPainter(tile)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.translate(-tile_rect(key).topLeft())
+        painter.fillRect(tile_rect(key), self.base)
+        painter.end()
+        return tile
+
+    def tile(self, key):
+        tile = self.peek(key)
+        return self.base_tile(key) if tile is None else tile
+
+    def writable(self, key):
+        tile = self.peek(key)
+        if tile is None:
+            tile = self.tiles[key] = QImage(self.base_tile(key))
+        return tile
+
+    def set(self, key, tile):
+        self.spilled.pop(key, None)
+        self.stored.pop(key, None)
+        if tile is None:
+            self.tiles.pop(key, None)
+        else:
+            self.tiles[key] = QImage(tile)
+
+    def pixel(self, x, y):
+        return self.tile((x // TILE_SIZE, y // TILE_SIZE)).pixel(x % TILE_SIZE, y % TILE_SIZE)
+
+    def keys_in(self, rect):
+        rect = rect.intersected(self.rect())
+        if rect.isEmpty():
+            return []
+        if len(self.tiles) + len(self.spilled) + len(self.stored) < \
+                (rect.width() // TILE_SIZE + 2) * (rect.height() // TILE_SIZE + 2):
+            return [key for key in self.allocated() if tile_rect(key).intersects(rect)]
+        return [key for key in tile_keys(rect, self.rect())
+                if key in self.tiles or key in self.spilled or key in self.stored]
+
+    def render_base(self, painter, rect):
+        if isinstance(self.base, TiledImage):
+            self.base.render(painter, rect)
+        else:
+            painter.fillRect(rect, self.base)
+
+    def render(self, painter, rect):
+        rect = rect.intersected(self.rect())
+        if rect.isEmpty():
+            return
+        painter.save()
+        painter.setClipRect(rect, Qt.IntersectClip if painter.hasClipping() else Qt.ReplaceClip)
+        self.render_base(painter, rect)
+        for key in self.keys_in(rect):
+            painter.drawImage(tile_rect(key).topLeft(), self.peek(key))
+        painter.restore()
+
+    def draw(self, rects, function):
+        keys = set()
+        for rect in rects:
+            keys.update(tile_keys(rect, self.rect()))
+        for key in keys:
+            painter = QPainter(self.writable(key))
+            painter.translate(-tile_rect(key).topLeft())
+            function(painter)
+            painter.end()
+
+    def copy(self, rect):
+        image = QImage(rect.size(), QImage.Format_ARGB32)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.translate(-rect.topLeft())
+        self.render(painter, rect)
+        painter.end()
+        return image
+
+    def to_image(self):
+        return self.copy(self.rect())
+
+    def scaled(self, width, height, base, smooth=True):
+        # Only tiles that cover painted source tiles are allocated; each is resampled from a source region
+        # with a margin so the filter sees across tile borders. Without smooth it is nearest-neighbour.
+        store = TiledImage(width, height, base)
+        sx, sy = width / self.w, height / self.h
+        keys = set()
+        for key in self.allocated():
+            source = QRectF(tile_rect(key))
+            target = QRectF(source.x() * sx, source.y() * sy, source.width() * sx, source.height() * sy)
+            keys.update(tile_keys(target.toAlignedRect(), store.rect()))
+        for key in keys:
+            target = QRectF(tile_rect(key))
+            source = QRectF(target.x() / sx, target.y() / sy, target.width() / sx, target.height() / sy)
+            region = source.toAlignedRect().adjusted(-2, -2, 2, 2).intersected(self.rect())
+            tile = store.tiles[key] = QImage(TILE_SIZE, TILE_SIZE, QImage.Format_ARGB32)
+            tile.fill(Qt.transparent)
+            painter = QPainter(tile)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            painter.setRenderHint(QPainter.SmoothPixmapTransform, smooth)
+            painter.translate(-target.topLeft())
+            painter.scale(sx, sy)
+            painter.drawImage(region.topLeft(), self.copy(region))
+            painter.end()
+        return store
+
+    def trim(self, limit=HOT_TILES):
+        while len(self.tiles) > limit:
+            key, tile = self.tiles.popitem(last=False)
+            # A solid_tile() shares its pixels with all the others, so it is set aside as it is.
+            self.spilled[key] = tile if tile.cacheKey() in SOLID_KEYS else SCRATCH.store(tile)
+
+    def compress(self, spill=False):
+        while self.tiles:
+            key, tile = self.tiles.popitem(last=False)
+            self.stored[key] = store_tile(tile, spill)
+        if spill:
+            for key, tile in self.stored.items():
+                self.stored[key] = store_tile(tile, True)
+
+
+class Composite:
+    # The layers (background first, then the drawing) flattened per tile. A flattened tile is cached until
+    # the canvas reports damage under it; tiles no layer has allocated are filled straight from the base.
+    def __init__(self, layers, limit=COMPOSITE_TILES):
+        self.layers, self.limit = layers, limit
+        self.tiles = OrderedDict()
+
+    def width(self):
+        return self.layers[0].width()
+
+    def height(self):
+        return self.layers[0].height()
+
+    def size(self):
+        return self.layers[0].size()
+
+    def rect(self):
+        return self.layers[0].rect()
+
+    def snapshot(self):
+        return Composite([layer.snapshot() for layer in self.layers])
+
+    def invalidate(self, rect):
+        if rect.isNull():
+            self.tiles.clear()
+        else:
+            for key in tile_keys(rect, self.rect()):
+                self.tiles.pop(key, None)
+
+    def tile(self, key):
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+        tile = self.layers[0].tile(key)
+        above = [layer.peek(key) for layer in self.layers[1:]]
+        if any(layer is not None for layer in above):
+            tile = QImage(tile)
+            painter = QPainter(tile)
+            for layer in above:
+                if layer is not None:
+                    painter.drawImage(0, 0, layer)
+            painter.end()
+        self.tiles[key] = tile
+        while len(self.tiles) > self.limit:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def pixel(self, x, y):
+        return self.tile((x // TILE_SIZE, y // TILE_SIZE)).pixel(x % TILE_SIZE, y % TILE_SIZE)
+
+    def solid_color(self, key):
+        # The rgba of the flattened tile at key if the layers show it is one colour without reading pixels:
+        # the background's colour where nothing is painted, or an opaque solid_tile() on top. Else None.
+        for layer in reversed(self.layers):
+            tile = layer.tiles.get(key, layer.spilled.get(key))
+            if tile is not None or key in layer.stored:
+                color = SOLID_KEYS.get(tile.cacheKey()) if isinstance(tile, QImage) else None
+                return color if color is not None and (layer is self.layers[0] or color >> 24 == 255) else None
+            if layer is not self.layers[0] and not (isinstance(layer.base, QColor) and layer.base.alpha() == 0):
+                return None
+        base = self.layers[0].base
+        return base.rgba() if isinstance(base, QColor) else None
+
+    def render(self, painter, rect):
+        rect = rect.intersected(self.rect())
+        if rect.isEmpty():
+            return
+        painter.save()
+        painter.setClipRect(rect, Qt.IntersectClip if painter.hasClipping() else Qt.ReplaceClip)
+        self.layers[0].render_base(painter, rect)
+        keys = set()
+        for layer in self.layers:
+            keys.update(layer.keys_in(rect))
+        for key in keys:
+            painter.drawImage(tile_rect(key).topLeft(), self.tile(key))
+        painter.restore()
+
+    def copy(self, rect):
+        image = QImage(rect.size(), QImage.Format_ARGB32)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.translate(-rect.topLeft())
+        self.render(painter, rect)
+        painter.end()
+        return image
+
+    def to_image(self):
+        return self.copy(self.rect())
+
+
+def scaled_base(base, sx, sy):
+    # Procedural backgrounds stay procedural across a rescale: a pattern brush just gets a scaled transform.
+    if isinstance(base, QBrush):
+        base = QBrush(base)
+        base.setTransform(base.transform() * QTransform.fromScale(sx, sy))
+    return base